@@ -0,0 +1,73 @@
+"""EPG 时间解析基准测试
+
+对比 dateutil 与 parse_xmltv_time 在单个时间戳和整份 XMLTV 解析上的耗时。
+在项目根目录运行：python -m benchmarks.epg_timestamps [--channels 200] [--days 7]
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services import epg
+from services.epg import EPGManager, parse_xmltv_time, _parse_time_fallback
+
+
+def build_feed(path: str, channels: int, days: int):
+    """生成一份每 30 分钟一个节目的 XMLTV 文件，返回其中的时间戳列表"""
+    base = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(days=1)
+    stamps = []
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n')
+        for c in range(channels):
+            f.write(f'<channel id="ch{c}"><display-name>频道{c}</display-name></channel>\n')
+        for c in range(channels):
+            for k in range(days * 48):
+                start = (base + timedelta(minutes=30 * k)).strftime("%Y%m%d%H%M%S +0800")
+                stop = (base + timedelta(minutes=30 * (k + 1))).strftime("%Y%m%d%H%M%S +0800")
+                stamps.append(start)
+                f.write(f'<programme channel="ch{c}" start="{start}" stop="{stop}"><title>节目{k}</title></programme>\n')
+        f.write("</tv>\n")
+    return stamps
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--channels", type=int, default=200)
+    ap.add_argument("--days", type=int, default=7)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_path = os.path.join(tmp, "feed.xml")
+        stamps = build_feed(xml_path, args.channels, args.days)
+        print(f"节目数: {len(stamps)}，文件大小: {os.path.getsize(xml_path) / 1024 / 1024:.1f} MB")
+
+        # 1. 单纯的时间戳解析
+        t_slow, slow = timed(lambda: [_parse_time_fallback(s) for s in stamps])
+        t_fast, fast = timed(lambda: [parse_xmltv_time(s) for s in stamps])
+        assert slow == fast, "解析结果不一致"
+        print(f"时间戳  dateutil: {t_slow:.2f}s  parse_xmltv_time: {t_fast:.2f}s  提升 {t_slow / t_fast:.1f}x")
+
+        # 2. 整份 XMLTV 解析 (_parse_epg_file 内部每个节目解析两次时间)
+        t_fast_feed, fast_data = timed(EPGManager._parse_epg_file, xml_path)
+        epg.parse_xmltv_time = _parse_time_fallback
+        try:
+            t_slow_feed, slow_data = timed(EPGManager._parse_epg_file, xml_path)
+        finally:
+            epg.parse_xmltv_time = parse_xmltv_time
+        assert {k: (list(v[0]), list(v[1]), v[2]) for k, v in slow_data["programs"].items()} == \
+               {k: (list(v[0]), list(v[1]), v[2]) for k, v in fast_data["programs"].items()}, "节目数据不一致"
+        print(f"整份解析  dateutil: {t_slow_feed:.2f}s  parse_xmltv_time: {t_fast_feed:.2f}s  提升 {t_slow_feed / t_fast_feed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
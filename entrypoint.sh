@@ -40,6 +40,16 @@ mkdir -p "$DATA_DIR/epg_cache"
 rm -rf /app/epg_cache
 ln -sfn "$DATA_DIR/epg_cache" /app/epg_cache
 
+# 5. 处理 thumb_cache (目录)
+mkdir -p "$DATA_DIR/thumb_cache"
+rm -rf /app/thumb_cache
+ln -sfn "$DATA_DIR/thumb_cache" /app/thumb_cache
+
+# 6. 处理 source_cache (目录)
+mkdir -p "$DATA_DIR/source_cache"
+rm -rf /app/source_cache
+ln -sfn "$DATA_DIR/source_cache" /app/source_cache
+
 echo "Data persistence setup complete. Starting application..."
 
 # 执行传入的命令 (CMD)
@@ -64,6 +64,13 @@ def migrate_db():
             session.exec(text("ALTER TABLE subscription ADD COLUMN epg_url VARCHAR"))
             session.commit()
         
+        try:
+            session.exec(text("SELECT content_hash FROM subscription LIMIT 1"))
+        except:
+            print("正在迁移 Subscription 表: 添加 content_hash 字段")
+            session.exec(text("ALTER TABLE subscription ADD COLUMN content_hash VARCHAR"))
+            session.commit()
+        
         # 频道表结构迁移
         try:
             session.exec(text("SELECT tvg_id FROM channel LIMIT 1"))
@@ -161,9 +168,34 @@ def migrate_db():
             session.exec(text("ALTER TABLE outputsource ADD COLUMN excluded_channel_ids VARCHAR DEFAULT '[]'"))
             session.commit()
 
+        try:
+            session.exec(text("SELECT request_count FROM outputsource LIMIT 1"))
+        except:
+            print("正在迁移 OutputSource 表: 添加 request_count 字段")
+            session.exec(text("ALTER TABLE outputsource ADD COLUMN request_count INTEGER DEFAULT 0"))
+            session.commit()
+
+        try:
+            session.exec(text("SELECT position FROM channel LIMIT 1"))
+        except:
+            print("正在迁移 Channel 表: 添加 position 字段")
+            session.exec(text("ALTER TABLE channel ADD COLUMN position INTEGER DEFAULT 0"))
+            session.commit()
+
+        # 频道按订阅差量同步、按订阅查询，需要 subscription_id 索引
+        session.exec(text("CREATE INDEX IF NOT EXISTS ix_channel_subscription_id ON channel (subscription_id)"))
+        session.commit()
+
+        # 旧版本把截图以 Base64 存在频道表里，迁移到磁盘缩略图库
+        from services.thumbs import ThumbStore
+        migrated = ThumbStore.migrate_inline_images(session)
+        if migrated:
+            print(f"已将 {migrated} 张频道截图迁移到缩略图库")
+
 async def auto_update_task():
     """后台自动同步订阅"""
     while True:
+        refreshed = False
         try:
             with Session(engine) as session:
                 # 1. 更新订阅
@@ -216,8 +248,9 @@ async def auto_update_task():
                                 # 此处不需要 process_subscription_refresh，因为步骤1已经刷过所有订阅
                                 # 直接刷新聚合 EPG (如果有)
                                 if out.epg_url:
-                                    from services.epg import fetch_epg_cached
-                                    await fetch_epg_cached(out.epg_url, refresh=True)
+                                    from services.epg import EPGManager
+                                    await EPGManager.refresh(out.epg_url)
+                                refreshed = True
                                 
                                 out.last_updated = now
                                 out.last_update_status = "自动更新成功"
@@ -229,21 +262,11 @@ async def auto_update_task():
                                 if out.auto_visual_check:
                                     print(f"[自动同步] 聚合源 {out.id} 开启了同步后深度检测，正在启动...")
                                     
-                                    from services.generator import M3UGenerator
-                                    from models import Channel
-                                    
-                                    # 1. 获取该聚合源关联的所有原始频道对象（带具体属性用于过滤）
-                                    raw_channels = []
-                                    for sid in sub_ids:
-                                        chs = session.exec(select(Channel).where(Channel.subscription_id == sid)).all()
-                                        raw_channels.extend(chs)
+                                    from services.filter_plan import FilterPlan
                                     
-                                    # 2. 应用聚合源的过滤逻辑（关键词+正则），这才能保证检测的是正确的频道
-                                    try:
-                                        keywords = json.loads(out.keywords)
-                                    except:
-                                        keywords = []
-                                    matched_channels = M3UGenerator.filter_channels(raw_channels, out.filter_regex, keywords)
+                                    # 对该聚合源关联的所有频道应用过滤逻辑（关键词+正则），这才能保证检测的是正确的频道
+                                    # 过滤计划与结果按规则内容缓存，同规则的聚合源只计算一次
+                                    matched_channels = FilterPlan.for_output(out).select_channels(session, sub_ids, use_exclusions=False)
                                     
                                     matched_ids = [c.id for c in matched_channels]
 
@@ -273,8 +296,48 @@ async def auto_update_task():
         except Exception as outer_e:
             print(f"[自动更新] 循环发生错误: {outer_e}")
             
+        # 有聚合源刷新过：在后台预热，内存中已是最新的 EPG 不会重复加载
+        if refreshed:
+            asyncio.create_task(prewarm_epg())
+
         await asyncio.sleep(30) # 每隔 30 秒检查一次，提高 2 分钟测试任务的灵敏度
 
+async def thumb_sweep_task():
+    """定期清理无人引用的检测截图"""
+    from services.thumbs import ThumbStore, THUMB_SWEEP_INTERVAL_HOURS
+    while True:
+        try:
+            def _sweep():
+                with Session(engine) as session:
+                    return ThumbStore.sweep(session)
+            removed = await asyncio.to_thread(_sweep)
+            if removed:
+                print(f"[截图清理] 已删除 {removed} 张无人引用的截图")
+        except Exception as e:
+            print(f"[截图清理] 失败: {e}")
+        await asyncio.sleep(THUMB_SWEEP_INTERVAL_HOURS * 3600)
+
+async def prewarm_epg():
+    """预热已启用的聚合源与订阅引用的 EPG，首个请求即可命中内存索引"""
+    from services.epg import EPGManager
+    try:
+        with Session(engine) as session:
+            urls = session.exec(select(OutputSource.epg_url).where(OutputSource.is_enabled == True, OutputSource.epg_url != None)).all()
+            urls += session.exec(select(Subscription.epg_url).where(Subscription.is_enabled == True, Subscription.epg_url != None)).all()
+        await EPGManager.prewarm(urls)
+    except Exception as e:
+        print(f"[EPG] 预热失败: {e}")
+
+async def request_flush_task():
+    """后台批量写入聚合源请求统计"""
+    from services.request_tracker import RequestTracker, FLUSH_INTERVAL
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(RequestTracker.flush, engine)
+        except Exception as e:
+            print(f"[请求统计] 落库失败: {e}")
+
 @app.on_event("startup")
 async def on_startup():
     """启动时初始化"""
@@ -297,6 +360,20 @@ async def on_startup():
             session.commit()
     
     asyncio.create_task(auto_update_task())
+    asyncio.create_task(request_flush_task())
+    asyncio.create_task(thumb_sweep_task())
+    asyncio.create_task(prewarm_epg())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """退出前把缓冲中的请求统计写入数据库，并关闭解析进程池"""
+    from services.request_tracker import RequestTracker
+    from services.parser import shutdown_parse_pool
+    try:
+        RequestTracker.flush(engine)
+    except Exception as e:
+        print(f"[请求统计] 落库失败: {e}")
+    shutdown_parse_pool()
 
 @app.get("/")
 def read_index():
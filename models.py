@@ -14,6 +14,7 @@ class Subscription(SQLModel, table=True):
     auto_update_minutes: int = Field(default=0) # 自动同步频率 (分钟)
     is_enabled: bool = Field(default=True) # 是否启用
     epg_url: Optional[str] = Field(default=None) # 自带 EPG 链接
+    content_hash: Optional[str] = Field(default=None) # 上次同步内容的指纹 (未变化时跳过同步)
 
     channels: List["Channel"] = Relationship(back_populates="subscription")
 
@@ -25,13 +26,14 @@ class Channel(SQLModel, table=True):
     group: Optional[str] = None # 频道分组
     logo: Optional[str] = None # 台标链接
     tvg_id: Optional[str] = Field(default=None) # EPG ID
-    subscription_id: int = Field(foreign_key="subscription.id") # 所属订阅
+    subscription_id: int = Field(foreign_key="subscription.id", index=True) # 所属订阅
+    position: int = Field(default=0) # 在订阅中的顺序
     is_enabled: bool = Field(default=True) # 是否启用该频道
     
     # 深度检测结果
     check_status: Optional[bool] = Field(default=None) # 检测是否通顺
     check_date: Optional[datetime] = Field(default=None) # 最后检测时间
-    check_image: Optional[str] = Field(default=None) # 频道截图 (Base64)
+    check_image: Optional[str] = Field(default=None) # 频道截图地址 (/thumbs/{key}.jpg)
     check_error: Optional[str] = Field(default=None) # 深度检测失败原因 (如无画面)
     check_source: Optional[str] = Field(default=None) # 检测来源: manual / auto
     
@@ -51,6 +53,7 @@ class OutputSource(SQLModel, table=True):
     last_updated: datetime = Field(default_factory=datetime.utcnow) # 最后同步时间
     last_update_status: Optional[str] = None # 最后同步状态
     last_request_time: Optional[datetime] = None # 最近被请求的时间
+    request_count: int = Field(default=0) # 累计被请求次数
     is_enabled: bool = Field(default=True) # 是否启用该聚合源
     auto_update_minutes: int = Field(default=0) # 自动同步频率 (分钟)
     auto_visual_check: bool = Field(default=False) # 同步后自动执行深度检测
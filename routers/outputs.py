@@ -1,28 +1,40 @@
-from fastapi import APIRouter, HTTPException, Depends, Response, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, Response, BackgroundTasks, Request
+from fastapi.responses import RedirectResponse, StreamingResponse
+from email.utils import format_datetime, parsedate_to_datetime
 from sqlmodel import Session, select
-from typing import List, Dict, Any
+from typing import Iterator, List, Dict, Any
+import os
 import json
-from datetime import datetime, timedelta
-import re
+import asyncio
+from datetime import datetime, timedelta, timezone
 
 from models import OutputSource, Subscription, Channel, TaskRecord
 from database import get_session
 from services.generator import M3UGenerator
-from services.epg import fetch_epg_cached
+from services.filter_plan import FilterPlan, ChannelPreviewRow
+from services.epg import EPGManager, epg_cache_path
 from services.stream_checker import StreamChecker
+from services.output_cache import OutputCache, OUTPUT_CACHE_ENABLED
+from services.request_tracker import RequestTracker
 from routers.subscriptions import process_subscription_refresh
 
 router = APIRouter(tags=["outputs"])
 
+# 对外访问地址 (如 https://iptv.example.com/)，用于播放列表中的 EPG 链接；未设置时按请求地址推断
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "")
+# 是否信任反向代理传来的 X-Forwarded-* 头 (客户端可任意伪造，只应在代理后部署时开启)
+TRUST_PROXY_HEADERS = bool(int(os.environ.get("TRUST_PROXY_HEADERS", "0")))
+
 @router.post("/outputs/", response_model=OutputSource)
 async def create_output(out: OutputSource, session: Session = Depends(get_session)):
     """新建聚合源"""
-    if out.epg_url:
-        await fetch_epg_cached(out.epg_url, refresh=True)
-        
     session.add(out)
     session.commit()
     session.refresh(out)
+
+    # EPG 在后台下载解析，不阻塞本次请求
+    if out.epg_url:
+        await EPGManager.warm(out.epg_url)
     return out
 
 @router.get("/outputs/")
@@ -38,25 +50,8 @@ def list_outputs(session: Session = Depends(get_session)):
         except:
             sub_ids = []
             
-        # 获取这些订阅下的所有频道
-        channels = session.exec(select(Channel).where(Channel.subscription_id.in_(sub_ids))).all()
-        
-        # 使用生成的逻辑进行过滤
-        try:
-            keywords = json.loads(out.keywords)
-        except:
-            keywords = []
-        
-        # 解析排除列表
-        try:
-            excluded_ids = json.loads(out.excluded_channel_ids or "[]")
-        except:
-            excluded_ids = []
-            
-        filtered = M3UGenerator.filter_channels(channels, out.filter_regex, keywords, excluded_ids)
-        
-        total = len(filtered)
-        enabled = len([c for c in filtered if c.is_enabled])
+        # 统计摘要按 (过滤规则, 频道快照) 缓存，规则或频道变化后才会重新计算
+        total, enabled = FilterPlan.for_output(out).count_channels(session, sub_ids)
         disabled = total - enabled
         
         # 转为字典并添加统计
@@ -66,6 +61,11 @@ def list_outputs(session: Session = Depends(get_session)):
             "enabled_count": enabled,
             "disabled_count": disabled
         })
+        # 合并尚未落库的请求统计
+        pending = RequestTracker.pending(out.id)
+        if pending:
+            out_dict["last_request_time"] = pending["last"]
+            out_dict["request_count"] = (out.request_count or 0) + pending["hits"]
         results.append(out_dict)
         
     return results
@@ -78,6 +78,7 @@ def delete_output(output_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="输出源不存在")
     session.delete(out)
     session.commit()
+    OutputCache.invalidate_output(out.slug)
     return {"message": "删除成功"}
 
 @router.put("/outputs/{output_id}", response_model=OutputSource)
@@ -93,6 +94,7 @@ def update_output(output_id: int, output_data: OutputSource, session: Session =
         if existing:
             raise HTTPException(status_code=400, detail="Slug 已被占用")
 
+    old_slug = output.slug
     output.name = output_data.name
     output.slug = output_data.slug
     output.filter_regex = output_data.filter_regex
@@ -108,6 +110,7 @@ def update_output(output_id: int, output_data: OutputSource, session: Session =
     session.add(output)
     session.commit()
     session.refresh(output)
+    OutputCache.invalidate_output(old_slug, output.slug)
     return output
 
 @router.post("/outputs/preview")
@@ -117,26 +120,16 @@ def preview_output(data: dict, session: Session = Depends(get_session)):
     raw_keywords = data.get("keywords", [])
     regex = data.get("filter_regex", ".*")
     excluded_ids = data.get("excluded_channel_ids", [])  # 聚合表级别排除
-    # 确保 ID 都是整数，防止前端传字符串导致匹配失败
-    try:
-        excluded_set = {int(i) for i in excluded_ids} if excluded_ids else set()
-    except:
-        excluded_set = set()
-    
-    # 整理关键字列表
-    keywords = []
-    for k in raw_keywords:
-        if isinstance(k, str):
-            keywords.append({"value": k, "group": ""})
-        elif isinstance(k, dict):
-            keywords.append(k)
+    # 整理关键字、编译正则（按规则内容缓存）
+    plan = FilterPlan.build(regex, raw_keywords, excluded_ids)
+    keywords = plan.keywords
 
     # 只要启用了的预览
-    enabled_subs = session.exec(select(Subscription.id).where(Subscription.is_enabled == True)).all()
-    active_sub_ids = [sid for sid in sub_ids if sid in enabled_subs] if sub_ids else enabled_subs
+    active_sub_ids = _active_sub_ids(session, sub_ids)
 
+    # 按列查询只读投影，不构造完整的模型对象
     if active_sub_ids:
-        channels = session.exec(select(Channel).where(Channel.subscription_id.in_(active_sub_ids))).all()
+        channels = ChannelPreviewRow.load(session, Channel.subscription_id.in_(active_sub_ids))
     else:
         channels = []
     
@@ -149,19 +142,15 @@ def preview_output(data: dict, session: Session = Depends(get_session)):
     sub_map = {s.id: s.name or s.url for s in subs}
 
     # 应用正则过滤
-    if regex and regex != ".*":
-        try:
-            pattern = re.compile(regex, re.IGNORECASE)
-            channels = [c for c in channels if pattern.search(c.name)]
-        except:
-            pass
+    if plan.pattern is not None:
+        channels = [c for c in channels if plan.pattern.search(c.name)]
 
     results = {}
     if not keywords:
         # 没搜到关键字就全给它
         channels = M3UGenerator.propagate_logos(channels)
         results["All"] = [
-            {**c.model_dump(), "source": sub_map.get(c.subscription_id, "Unknown")} 
+            {**c.to_dict(), "source": sub_map.get(c.subscription_id, "Unknown")} 
             for c in channels 
         ]
     else:
@@ -177,7 +166,7 @@ def preview_output(data: dict, session: Session = Depends(get_session)):
             
             display_key = f"{k_val} → {k_group}" if k_group else k_val
             results[display_key] = [
-                {**c.model_dump(), "source": sub_map.get(c.subscription_id, "Unknown")} 
+                {**c.to_dict(), "source": sub_map.get(c.subscription_id, "Unknown")} 
                 for c in matches 
             ]
             
@@ -242,8 +231,15 @@ async def refresh_output(output_id: int, background_tasks: BackgroundTasks, sess
         if out.epg_url:
             await update_task_status(task_id, progress=50, message="正在更新 EPG...")
             try:
-                await fetch_epg_cached(out.epg_url, refresh=True)
+                await EPGManager.refresh(out.epg_url)
             except: pass
+
+        # 预热该聚合源用到的所有 EPG，刷新完成后的首个请求即可命中
+        try:
+            active_sub_ids = _active_sub_ids(session, sub_ids)
+            await EPGManager.prewarm(_epg_sources(out, session.exec(select(Subscription)).all(), active_sub_ids))
+        except Exception as e:
+            print(f"[EPG] 预热失败: {e}")
                 
         out.last_updated = datetime.utcnow()
         out.last_update_status = "手动更新成功"
@@ -283,16 +279,8 @@ async def run_output_visual_check_v2(output_id: int, task_id: str, force_check:
         
         try:
             sub_ids = json.loads(out.subscription_ids)
-            raw_channels = []
-            for sid in sub_ids:
-                chs = session.exec(select(Channel).where(Channel.subscription_id == sid)).all()
-                raw_channels.extend(chs)
-            
-            try: keywords = json.loads(out.keywords)
-            except: keywords = []
-            
-            from services.generator import M3UGenerator
-            matched_channels = M3UGenerator.filter_channels(raw_channels, out.filter_regex, keywords)
+            # 检测覆盖关联订阅下所有命中规则的频道（不受排除列表影响）
+            matched_channels = FilterPlan.for_output(out).select_channels(session, sub_ids, use_exclusions=False)
             
             if matched_channels:
                 from services.stream_checker import StreamChecker
@@ -353,18 +341,8 @@ async def run_output_visual_check(output_id: int, force_check: bool = False):
 
         try:
             sub_ids = json.loads(out.subscription_ids)
-            raw_channels = []
-            for sid in sub_ids:
-                chs = session.exec(select(Channel).where(Channel.subscription_id == sid)).all()
-                raw_channels.extend(chs)
-            
-            try:
-                keywords = json.loads(out.keywords)
-            except:
-                keywords = []
-            
-            from services.generator import M3UGenerator
-            matched_channels = M3UGenerator.filter_channels(raw_channels, out.filter_regex, keywords)
+            # 检测覆盖关联订阅下所有命中规则的频道（不受排除列表影响）
+            matched_channels = FilterPlan.for_output(out).select_channels(session, sub_ids, use_exclusions=False)
             
             # 彻底移除冷却限制：只要触发此任务，就对所有匹配频道进行探测
             pending_channels = matched_channels
@@ -391,62 +369,201 @@ async def run_output_visual_check(output_id: int, force_check: bool = False):
         except Exception as e:
             print(f"[后台检测] 聚合源 {out.id} 执行失败: {e}")
 
-@router.get("/m3u/{slug}")
-async def get_m3u_output(slug: str, session: Session = Depends(get_session)):
-    """下载 M3U"""
-    out = session.exec(select(OutputSource).where(OutputSource.slug == slug)).first()
-    if not out:
-        raise HTTPException(status_code=404, detail="输出源不存在")
-    
+def _active_sub_ids(session: Session, sub_ids: List[int]) -> List[int]:
+    """关联订阅中已启用的部分 (未指定订阅时取全部已启用的订阅)"""
+    enabled_subs = session.exec(select(Subscription.id).where(Subscription.is_enabled == True)).all()
+    return [sid for sid in sub_ids if sid in enabled_subs] if sub_ids else enabled_subs
 
-    out.last_request_time = datetime.utcnow()
-    session.add(out)
-    session.commit()
-    session.refresh(out) # 确保状态同步
-    
+def _epg_sources(out: OutputSource, subs: List[Subscription], active_sub_ids: List[int]) -> List[str]:
+    """聚合源的 EPG 来源：自身配置的在前，其后是关联订阅自带的 (去重)"""
+    urls = [out.epg_url] if out.epg_url else []
+    sub_epg = {s.id: s.epg_url for s in subs if s.epg_url}
+    for sid in active_sub_ids:
+        url = sub_epg.get(sid)
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+def _render_m3u(session: Session, out: OutputSource, sub_ids: List[int], base_url: str = "") -> Iterator[bytes]:
+    """渲染聚合源的 M3U，返回逐块生成的字节 (频道在调用时即已取出，迭代过程不访问数据库)"""
     # 检查是否启用
     if not out.is_enabled:
-        return Response(content="#EXTM3U\n# 频道已暂时下线，请在后台启用该聚合源后重试。", media_type="text/plain; charset=utf-8")
+        return iter(["#EXTM3U\n# 频道已暂时下线，请在后台启用该聚合源后重试。".encode("utf-8")])
 
-    try:
-        sub_ids = json.loads(out.subscription_ids)
-    except:
-        sub_ids = []
-    
     # 取出刷新的最新频道
-    enabled_subs = session.exec(select(Subscription.id).where(Subscription.is_enabled == True)).all()
-    active_sub_ids = [sid for sid in sub_ids if sid in enabled_subs] if sub_ids else enabled_subs
-
-    if active_sub_ids:
-        # 只要启用了的
-        channels = session.exec(select(Channel).where(
-            Channel.subscription_id.in_(active_sub_ids),
-            Channel.is_enabled == True
-        )).all()
-    else:
-        channels = []
+    active_sub_ids = _active_sub_ids(session, sub_ids)
 
     subs = session.exec(select(Subscription)).all()
     sub_map = {s.id: s.name or s.url for s in subs}
 
-    try:
-        raw_keywords = json.loads(out.keywords)
-        keywords = []
-        for k in raw_keywords:
-            if isinstance(k, str):
-                keywords.append({"value": k, "group": ""})
-            elif isinstance(k, dict):
-                keywords.append(k)
-    except:
-        keywords = []
-    
-    # 解析排除列表
-    try:
-        excluded_ids = json.loads(out.excluded_channel_ids or "[]")
-    except:
-        excluded_ids = []
-        
-    # 过滤、生成 M3U 
-    filtered = M3UGenerator.filter_channels(channels, out.filter_regex, keywords, excluded_ids)
-    m3u_content = M3UGenerator.generate_m3u(filtered, sub_map, out.epg_url, out.include_source_suffix)
-    return Response(content=m3u_content, media_type="application/x-mpegurl; charset=utf-8")
+    # 只要启用了的频道，过滤结果由规则相同的聚合源共享
+    filtered = FilterPlan.for_output(out).select_channels(session, active_sub_ids, enabled_only=True)
+    # 有 EPG 来源时指向本服务生成的精简 EPG，播放器只需下载用得到的频道
+    epg_url = f"{base_url}epg/{out.slug}.xml.gz" if _epg_sources(out, subs, active_sub_ids) else None
+    return M3UGenerator.iter_m3u(filtered, sub_map, epg_url, out.include_source_suffix)
+
+def _last_modified(out: OutputSource, sub_ids: List[int]) -> datetime:
+    """关联订阅的频道或聚合源配置最近一次变化的时间
+
+    不使用订阅/聚合源的 last_updated：它们在内容未变化的定时刷新时也会更新，
+    会让 If-Modified-Since 白白失效；真正的变化都会经过 OutputCache 的失效记录。
+    """
+    return OutputCache.changed_at(sub_ids, out.slug)
+
+def _accepted_encodings(request: Request) -> set:
+    """解析 Accept-Encoding，返回客户端可接受的编码 (忽略 q=0)"""
+    accepted = set()
+    for part in request.headers.get("accept-encoding", "").split(","):
+        token, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        if token:
+            accepted.add(token.strip().lower())
+    return accepted
+
+def _cached_response(request: Request, entry: dict, media_type: str) -> Response:
+    """按协商结果返回缓存内容：支持 ETag/Last-Modified 条件请求与 br/gzip 预压缩版本"""
+    accepted = _accepted_encodings(request)
+    if entry.get("br") and "br" in accepted:
+        encoding, body = "br", entry["br"]
+    elif entry.get("gzip") and "gzip" in accepted:
+        encoding, body = "gzip", entry["gzip"]
+    else:
+        encoding, body = None, entry["body"]
+
+    # 不同编码的字节不同，ETag 需带上编码后缀；比较时去掉后缀再对比内容哈希
+    etag = f'"{entry["etag"]}-{encoding}"' if encoding else f'"{entry["etag"]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(entry["last_modified"].replace(tzinfo=timezone.utc), usegmt=True),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            tag = tag.strip('"').split("-", 1)[0]
+            if tag == entry["etag"] or tag == "*":
+                return Response(status_code=304, headers=headers)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).astimezone(timezone.utc).replace(tzinfo=None)
+                if entry["last_modified"] <= since:
+                    return Response(status_code=304, headers=headers)
+            except (TypeError, ValueError):
+                pass
+
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+def _public_base_url(request: Request) -> str:
+    """对外访问地址 (以 / 结尾)：优先用 PUBLIC_BASE_URL，其次是 (已开启信任时) 反向代理传来的 X-Forwarded-* 头
+
+    该地址也是播放列表缓存的 variant，不可信的请求头不能参与，否则每次换个值就能绕过缓存并挤掉正常条目。
+    """
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL.rstrip("/") + "/"
+    host = request.headers.get("x-forwarded-host") if TRUST_PROXY_HEADERS else None
+    if not host:
+        return str(request.base_url)
+    # 多级代理时取第一个 (最靠近客户端的) 值
+    proto = request.headers.get("x-forwarded-proto", request.url.scheme).split(",")[0].strip()
+    prefix = request.headers.get("x-forwarded-prefix", "").split(",")[0].strip().rstrip("/")
+    return f"{proto}://{host.split(',')[0].strip()}{prefix}/"
+
+@router.get("/m3u/{slug}")
+async def get_m3u_output(slug: str, request: Request, session: Session = Depends(get_session)):
+    """下载 M3U"""
+    # 播放列表里的 EPG 地址是绝对地址，按对外访问地址分别缓存
+    base_url = _public_base_url(request)
+    # 命中渲染缓存直接返回，读路径不访问数据库
+    entry = OutputCache.get(slug, base_url) if OUTPUT_CACHE_ENABLED else None
+    if entry is None:
+        out = session.exec(select(OutputSource).where(OutputSource.slug == slug)).first()
+        if not out:
+            raise HTTPException(status_code=404, detail="输出源不存在")
+
+        try:
+            sub_ids = json.loads(out.subscription_ids)
+        except:
+            sub_ids = []
+        # 先取版本再渲染，渲染期间若发生失效，这份结果下次读取时自然作废
+        token = OutputCache.token(slug, sub_ids)
+        media_type = "application/x-mpegurl; charset=utf-8" if out.is_enabled else "text/plain; charset=utf-8"
+        # 查询频道、生成与压缩都是同步的 CPU/IO 操作，放到线程池执行，不阻塞事件循环
+        loop = asyncio.get_event_loop()
+
+        if not OUTPUT_CACHE_ENABLED:
+            # 不缓存时边生成边发送，不在内存中拼出整份播放列表 (StreamingResponse 在线程池中迭代同步生成器)
+            chunks = await loop.run_in_executor(None, _render_m3u, session, out, sub_ids, base_url)
+            RequestTracker.touch(out.id)
+            return StreamingResponse(chunks, media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+        def _build():
+            # 生成的字节块直接写入缓存条目与压缩流
+            chunks = _render_m3u(session, out, sub_ids, base_url)
+            return OutputCache.build_entry(token, sub_ids, chunks, _last_modified(out, sub_ids))
+        entry = await loop.run_in_executor(None, _build)
+        entry["output_id"] = out.id
+        entry["media_type"] = media_type
+        OutputCache.put(slug, entry, base_url)
+
+    # 请求时间与次数只记在内存，由后台任务批量落库
+    RequestTracker.touch(entry["output_id"])
+    return _cached_response(request, entry, entry["media_type"])
+
+def _epg_stamp(epg_entries) -> tuple:
+    """EPG 版本：任一来源的 XML 更新或索引重新加载后都会改变"""
+    return tuple((url, tuple(e.get("source") or ()), e.get("built_at")) for url, e in epg_entries.items())
+
+@router.get("/epg/{slug}.xml.gz")
+async def get_epg_output(slug: str, request: Request, session: Session = Depends(get_session)):
+    """下载聚合源的精简 EPG (只含该聚合源输出的频道)"""
+    entry = OutputCache.get(slug, "epg")
+    if entry is not None:
+        # 频道未变化时，还要确认 EPG 索引没有重新加载过
+        epg_entries = await EPGManager.get_entries(entry["epg_urls"])
+        if _epg_stamp(epg_entries) != entry["epg_stamp"]:
+            entry = None
+
+    if entry is None:
+        out = session.exec(select(OutputSource).where(OutputSource.slug == slug)).first()
+        if not out or not out.is_enabled:
+            raise HTTPException(status_code=404, detail="输出源不存在")
+
+        try:
+            sub_ids = json.loads(out.subscription_ids)
+        except:
+            sub_ids = []
+        token = OutputCache.token(slug, sub_ids)
+        active_sub_ids = _active_sub_ids(session, sub_ids)
+        subs = session.exec(select(Subscription)).all()
+        epg_urls = _epg_sources(out, subs, active_sub_ids)
+        if not epg_urls:
+            raise HTTPException(status_code=404, detail="该聚合源没有 EPG")
+
+        epg_entries = await EPGManager.get_entries(epg_urls)
+        if not epg_entries:
+            # EPG 还没加载好，先让播放器直接使用上游地址
+            return RedirectResponse(epg_urls[0], status_code=307)
+
+        channels = FilterPlan.for_output(out).select_channels(session, active_sub_ids, enabled_only=True)
+        sources = [(epg_cache_path(url), e) for url, e in epg_entries.items()]
+        loop = asyncio.get_event_loop()
+        body = await loop.run_in_executor(None, EPGManager.build_xmltv, sources, channels)
+
+        built_at = max(e.get("built_at") or 0 for e in epg_entries.values())
+        last_modified = max(_last_modified(out, sub_ids), datetime.utcfromtimestamp(built_at))
+        entry = OutputCache.build_entry(token, sub_ids, body, last_modified, compress=False)
+        entry["epg_urls"] = epg_urls
+        entry["epg_stamp"] = _epg_stamp(epg_entries)
+        OutputCache.put(slug, entry, "epg")
+
+    return _cached_response(request, entry, "application/gzip")
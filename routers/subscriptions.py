@@ -1,10 +1,12 @@
 from fastapi import APIRouter, HTTPException, Depends
-from sqlmodel import Session, select
+from sqlmodel import Session, select, func
 from typing import List
 from models import Subscription, Channel, TaskRecord
 from database import get_session, engine
 from services.fetcher import IPTVFetcher, fetch_subscription_task
 from services.epg import fetch_epg_cached
+from services.output_cache import OutputCache
+from services.channel_sync import sync_subscription_channels, prune_excluded_ids
 from datetime import datetime
 import uuid
 from task_broker import update_task_status
@@ -60,9 +62,11 @@ def delete_subscription(sub_id: int, session: Session = Depends(get_session)):
     channels = session.exec(select(Channel).where(Channel.subscription_id == sub_id)).all()
     for c in channels:
         session.delete(c)
+    prune_excluded_ids(session, [c.id for c in channels])
         
     session.delete(sub)
     session.commit()
+    OutputCache.invalidate_subscriptions([sub_id])
     return {"message": "删除成功"}
 
 @router.put("/{sub_id}", response_model=Subscription)
@@ -80,6 +84,8 @@ def update_subscription(sub_id: int, updated: Subscription, session: Session = D
     session.add(db_sub)
     session.commit()
     session.refresh(db_sub)
+    # 订阅名 (来源后缀) 和启用状态都会影响输出
+    OutputCache.invalidate_subscriptions([sub_id])
     return db_sub
 
 @router.get("/{sub_id}/channels", response_model=List[Channel])
@@ -88,52 +94,29 @@ def get_subscription_channels(sub_id: int, session: Session = Depends(get_sessio
     sub = session.get(Subscription, sub_id)
     if not sub:
         raise HTTPException(status_code=404, detail="订阅不存在")
-    channels = session.exec(select(Channel).where(Channel.subscription_id == sub_id)).all()
+    channels = session.exec(select(Channel).where(Channel.subscription_id == sub_id).order_by(Channel.position, Channel.id)).all()
     return channels
 
 async def process_subscription_refresh(session: Session, sub: Subscription) -> int:
     """同步订阅（支持 M3U/TXT/Git 混合及多地址）"""
-    # 1. 记住当前已有的状态（禁用状态、检测结果），防止刷新后丢失
-    old_channels = session.exec(select(Channel).where(Channel.subscription_id == sub.id)).all()
-    
-    # 建立以 URL 为 Key 的状态映射表
-    channel_states = {}
-    for c in old_channels:
-        channel_states[c.url] = {
-            "is_enabled": c.is_enabled,
-            "check_status": c.check_status,
-            "check_date": c.check_date,
-            "check_image": c.check_image
-        }
-    
-    # 2. 清掉旧台
-    for c in old_channels:
-        session.delete(c)
-    
-    # 3. 抓取并解析
-    channels_data, metadata = await IPTVFetcher.fetch_subscription(sub.url, sub.user_agent, sub.headers)
-    
-    for item in channels_data:
-        # 尝试从映射表中恢复状态
-        url = item.get("url")
-        state = channel_states.get(url, {})
-        
-        is_enabled = state.get("is_enabled", True)
-        
-        channel = Channel(
-            **item, 
-            subscription_id=sub.id, 
-            is_enabled=is_enabled,
-            check_status=state.get("check_status"),
-            check_date=state.get("check_date"),
-            check_image=state.get("check_image")
-        )
-        session.add(channel)
+    # 1. 抓取并解析
+    channels_data, metadata, content_hash = await IPTVFetcher.fetch_subscription(sub.url, sub.user_agent, sub.headers, known_hash=sub.content_hash)
     
     sub.last_updated = datetime.utcnow()
     sub.last_update_status = "Success"
+    if channels_data is None:
+        # 所有源都没有变化：跳过入库
+        session.add(sub)
+        session.commit()
+        return session.exec(select(func.count(Channel.id)).where(Channel.subscription_id == sub.id)).one()
+
+    # 2. 与已有频道差量同步，保留频道 ID 与启用/检测状态
+    sync_subscription_channels(session, sub.id, channels_data)
+    
+    sub.content_hash = content_hash
     session.add(sub)
     session.commit()
+    OutputCache.invalidate_subscriptions([sub.id])
     return len(channels_data)
 
 @router.post("/{sub_id}/refresh")
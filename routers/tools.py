@@ -1,4 +1,5 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
 import asyncio
 import aiohttp
 import os
@@ -7,6 +8,7 @@ from sqlmodel import SQLModel
 
 from services.connectivity import check_url
 from services.epg import EPGManager, fetch_epg_cached, md5
+from services.thumbs import ThumbStore
 
 router = APIRouter(tags=["tools"])
 
@@ -34,6 +36,31 @@ async def get_epg_current(epg_url: str, tvg_id: str = None, tvg_name: str = None
     prog_data = await EPGManager.get_program(epg_url, tvg_id, tvg_name, current_logo, refresh=refresh)
     return {"program": prog_data.get("title", ""), "logo": prog_data.get("logo")}
 
+class EPGBatchRequest(SQLModel):
+    """批量节目查询"""
+    epg_url: str
+    items: list[dict] = [] # 包含 {tvg_id, tvg_name, current_logo} 的列表
+    refresh: bool = False
+
+@router.post("/api/epg/batch")
+async def get_epg_batch(req: EPGBatchRequest):
+    """一次查询整批频道的当前/下一个节目"""
+    results = await EPGManager.get_programs(req.epg_url, req.items, refresh=req.refresh)
+    return {"results": [
+        {"program": r.get("title", ""), "next": r.get("next"), "logo": r.get("logo")}
+        for r in results
+    ]}
+
+@router.get("/thumbs/{key}.jpg")
+def get_thumb(key: str):
+    """检测截图（内容寻址，永不变化，可长期缓存）"""
+    path = ThumbStore.path(key)
+    if not path or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="截图不存在")
+    return FileResponse(path, media_type="image/jpeg", headers={
+        "Cache-Control": "public, max-age=31536000, immutable"
+    })
+
 @router.post("/check-connectivity")
 async def check_connectivity(req: CheckRequest):
     """快速连通性检测（通不通）"""
@@ -0,0 +1,205 @@
+import json
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Iterable, List, Optional
+from sqlalchemy import bindparam, delete
+from sqlmodel import Session, select
+
+from models import Channel, OutputSource
+
+# 每批写入的行数 (executemany)
+SYNC_BATCH_SIZE = 500
+# 频道顺序 (position) 的间隔：中间插入新频道时放进空隙，后面的行不用整体改写
+POSITION_GAP = 1024
+
+# 同步时由订阅内容决定的字段
+_CONTENT_FIELDS = ("name", "group", "logo", "tvg_id", "position")
+# 新增频道时按 URL 从旧频道继承的状态字段
+_STATE_FIELDS = ("is_enabled", "check_status", "check_date", "check_image", "check_error", "check_source")
+
+_channel_table = Channel.__table__
+_update_stmt = _channel_table.update().where(_channel_table.c.id == bindparam("_id")).values(
+    **{field: bindparam(f"_{field}") for field in _CONTENT_FIELDS}
+)
+
+
+def prune_excluded_ids(session: Session, deleted_ids: Iterable[int]):
+    """从各聚合源的排除列表中移除已删除的频道 ID
+
+    频道表的 ID 没有 AUTOINCREMENT，删除后最大的 ID 会被新频道复用；
+    不及时清理的话，旧的排除项会把无关的新频道排除掉。调用方负责 commit。
+    """
+    deleted = set(deleted_ids)
+    if not deleted:
+        return
+    for out in session.exec(select(OutputSource)).all():
+        try:
+            excluded = json.loads(out.excluded_channel_ids or "[]")
+        except:
+            continue
+        # 前端可能传来字符串形式的 ID
+        kept = []
+        for i in excluded:
+            try:
+                if int(i) in deleted:
+                    continue
+            except (TypeError, ValueError):
+                pass
+            kept.append(i)
+        if len(kept) != len(excluded):
+            out.excluded_channel_ids = json.dumps(kept)
+            session.add(out)
+
+
+def _assign_positions(old_positions: List[Optional[int]]) -> List[int]:
+    """按新顺序给频道分配 position，尽量沿用旧值
+
+    old_positions 为新顺序下每个频道原来的 position (新频道为 None)。
+    旧值中最长的递增子序列原样保留，其余频道放进相邻保留值之间的空隙；
+    空隙不够时才按 POSITION_GAP 重新编号全部频道。
+    """
+    n = len(old_positions)
+    # 最长严格递增子序列 (O(n log n))
+    tails, tail_idx, prev = [], [], [-1] * n
+    for i, pos in enumerate(old_positions):
+        if pos is None:
+            continue
+        k = bisect_left(tails, pos)
+        if k == len(tails):
+            tails.append(pos)
+            tail_idx.append(i)
+        else:
+            tails[k] = pos
+            tail_idx[k] = i
+        prev[i] = tail_idx[k - 1] if k else -1
+    kept = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i != -1:
+        kept.append(i)
+        i = prev[i]
+    kept.reverse()
+
+    if not kept:
+        return [(i + 1) * POSITION_GAP for i in range(n)]
+
+    result = [None] * n
+    for i in kept:
+        result[i] = old_positions[i]
+    # 依次填充保留值之间 (以及首尾) 的空隙
+    bounds = [-1] + kept + [n]
+    for left, right in zip(bounds, bounds[1:]):
+        count = right - left - 1
+        if count <= 0:
+            continue
+        if left == -1:
+            hi = result[right]
+            for j in range(count):
+                result[left + 1 + j] = hi - POSITION_GAP * (count - j)
+        elif right == n:
+            lo = result[left]
+            for j in range(count):
+                result[left + 1 + j] = lo + POSITION_GAP * (j + 1)
+        else:
+            lo, hi = result[left], result[right]
+            step = (hi - lo) // (count + 1)
+            if step < 1:
+                return [(i + 1) * POSITION_GAP for i in range(n)]
+            for j in range(count):
+                result[left + 1 + j] = lo + step * (j + 1)
+    return result
+
+
+def sync_subscription_channels(session: Session, sub_id: int, items: List[dict], is_canceled: Optional[Callable[[], bool]] = None) -> Optional[dict]:
+    """把抓取结果差量同步到频道表
+
+    以 (URL, 名称) 为键与已有频道比对，其次按 URL 匹配改名的频道，
+    只对变化的行做批量 INSERT / UPDATE / DELETE。已有频道的 ID、启用状态和检测结果保持不变，
+    顺序用带间隔的 position 表示，插入或删除个别频道不会改写其后的所有行。
+    is_canceled 每批写入前调用一次，返回 True 时回滚并返回 None。
+    调用方负责 commit。
+    """
+    existing = session.exec(
+        select(Channel.id, Channel.url, *[getattr(Channel, f) for f in _CONTENT_FIELDS], *[getattr(Channel, f) for f in _STATE_FIELDS])
+        .where(Channel.subscription_id == sub_id)
+        .order_by(Channel.id)
+    ).all()
+
+    by_key = defaultdict(list)
+    state_by_url = {}
+    for row in existing:
+        by_key[(row.url, row.name)].append(row)
+        state_by_url.setdefault(row.url, row)
+
+    # 1. 以 (URL, 名称) 精确匹配
+    matched = {} # 新数据下标 -> 旧行
+    for idx, item in enumerate(items):
+        rows = by_key.get((item.get("url"), item.get("name")))
+        if rows:
+            matched[idx] = rows.pop(0)
+
+    # 2. 剩下的按 URL 匹配 (频道改名)
+    leftover_by_url = defaultdict(list)
+    for rows in by_key.values():
+        for row in rows:
+            leftover_by_url[row.url].append(row)
+    for idx, item in enumerate(items):
+        if idx in matched:
+            continue
+        rows = leftover_by_url.get(item.get("url"))
+        if rows:
+            matched[idx] = rows.pop(0)
+
+    # 3. 计算差异 (顺序没变的频道保留原 position，只改写真正移动了的行)
+    positions = _assign_positions([matched[idx].position if idx in matched else None for idx in range(len(items))])
+    inserts, updates = [], []
+    for idx, item in enumerate(items):
+        values = {
+            "name": item.get("name"),
+            "group": item.get("group"),
+            "logo": item.get("logo"),
+            "tvg_id": item.get("tvg_id"),
+            "position": positions[idx]
+        }
+        row = matched.get(idx)
+        if row is not None:
+            if any(getattr(row, f) != values[f] for f in _CONTENT_FIELDS):
+                updates.append({"_id": row.id, **{f"_{f}": v for f, v in values.items()}})
+            continue
+
+        # 新频道：同 URL 的旧频道有状态就继承过来
+        state = state_by_url.get(item.get("url"))
+        inserts.append({
+            **values,
+            "url": item.get("url"),
+            "subscription_id": sub_id,
+            **{f: (getattr(state, f) if state is not None else None) for f in _STATE_FIELDS},
+            "is_enabled": state.is_enabled if state is not None and state.is_enabled is not None else True
+        })
+
+    matched_ids = {row.id for row in matched.values()}
+    deletes = [row.id for row in existing if row.id not in matched_ids]
+
+    # 4. 分批写入
+    def _canceled() -> bool:
+        if is_canceled and is_canceled():
+            session.rollback()
+            return True
+        return False
+
+    for i in range(0, len(deletes), SYNC_BATCH_SIZE):
+        if _canceled(): return None
+        session.exec(delete(Channel).where(Channel.id.in_(deletes[i:i + SYNC_BATCH_SIZE])))
+    prune_excluded_ids(session, deletes)
+    for i in range(0, len(updates), SYNC_BATCH_SIZE):
+        if _canceled(): return None
+        session.exec(_update_stmt, params=updates[i:i + SYNC_BATCH_SIZE])
+    for i in range(0, len(inserts), SYNC_BATCH_SIZE):
+        if _canceled(): return None
+        session.exec(_channel_table.insert(), params=inserts[i:i + SYNC_BATCH_SIZE])
+
+    return {
+        "inserted": len(inserts),
+        "updated": len(updates),
+        "deleted": len(deletes),
+        "unchanged": len(matched) - len(updates)
+    }
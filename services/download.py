@@ -0,0 +1,94 @@
+import os
+import uuid
+import zlib
+import hashlib
+import aiohttp
+
+# 每次从网络读取的块大小
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# 下载大小上限 (解压后，单位 MB)，可用环境变量覆盖
+MAX_SUBSCRIPTION_SIZE_MB = int(os.environ.get("MAX_SUBSCRIPTION_SIZE_MB", "200"))
+MAX_EPG_SIZE_MB = int(os.environ.get("MAX_EPG_SIZE_MB", "1024"))
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+class DownloadTooLarge(Exception):
+    """下载内容超过大小上限"""
+
+
+class _Gunzip:
+    """增量 gzip 解压，支持多段拼接的 gzip 文件；单次输出不超过 DOWNLOAD_CHUNK_SIZE"""
+
+    def __init__(self):
+        self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def feed(self, data: bytes):
+        while data:
+            out = self._d.decompress(data, DOWNLOAD_CHUNK_SIZE)
+            if out:
+                yield out
+            if self._d.eof:
+                # 本段结束，剩余数据属于下一段 gzip
+                data = self._d.unused_data
+                if data:
+                    self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                # 输出达到上限时，未处理的输入留在 unconsumed_tail
+                data = self._d.unconsumed_tail
+
+    def close(self):
+        out = self._d.flush()
+        if out:
+            yield out
+        # 最后一段没有读到结尾 (连接中断等导致的截断)：报错以丢弃临时文件，保留原有缓存
+        if not self._d.eof:
+            raise EOFError("gzip 数据不完整")
+
+
+async def download_to_file(response: aiohttp.ClientResponse, dest_path: str, max_bytes: int) -> dict:
+    """把响应体分块写入 dest_path，gzip 内容边下载边解压
+
+    先写临时文件，完成后原子替换；内存占用只与块大小有关。
+    超过 max_bytes (解压后) 时抛出 DownloadTooLarge，已有的 dest_path 保持不变。
+    返回 {"size": 字节数, "sha256": 内容哈希}。
+    """
+    tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp" # 同一地址可能被并发下载
+    digest = hashlib.sha256()
+    size = 0
+    gunzip = None
+    head = b"" # 凑够文件头再判断是否为 gzip
+    try:
+        with open(tmp_path, "wb") as f:
+            def _write(data: bytes):
+                nonlocal size
+                size += len(data)
+                if size > max_bytes:
+                    raise DownloadTooLarge(f"内容超过上限 {max_bytes // (1024 * 1024)} MB")
+                digest.update(data)
+                f.write(data)
+
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if head is not None:
+                    head += chunk
+                    if len(head) < len(_GZIP_MAGIC):
+                        continue
+                    chunk, head = head, None
+                    # 按文件头识别 gzip (比 URL 后缀更可靠)
+                    if chunk.startswith(_GZIP_MAGIC):
+                        gunzip = _Gunzip()
+                if gunzip:
+                    for out in gunzip.feed(chunk):
+                        _write(out)
+                else:
+                    _write(chunk)
+            if head:
+                _write(head)
+            if gunzip:
+                for out in gunzip.close():
+                    _write(out)
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {"size": size, "sha256": digest.hexdigest()}
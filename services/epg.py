@@ -1,90 +1,285 @@
+import io
 import os
-import time
+import re
 import gzip
-import io
+import json
+import time
+import sys
+import marshal
 import asyncio
+from array import array
+from bisect import bisect_right
 import aiohttp
 import xml.etree.ElementTree as ET
 from hashlib import md5
-from datetime import datetime, timezone
-from typing import Dict, Any, List
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Optional
+from xml.sax.saxutils import escape, quoteattr
 from dateutil import parser as date_parser
 import zhconv
 
+from services.download import download_to_file, MAX_EPG_SIZE_MB
+
 # EPG 缓存目录
 EPG_CACHE_DIR = "./epg_cache"
 if not os.path.exists(EPG_CACHE_DIR):
     os.makedirs(EPG_CACHE_DIR, exist_ok=True)
 
+# EPG 索引格式版本 (结构或名称清洗规则变化时递增，旧索引自动重建)
+EPG_INDEX_VERSION = 4
+
+# 节目保留窗口：解析时只保留 [现在 - 6 小时, 现在 + 48 小时] 内的节目 (可用环境变量覆盖)
+EPG_RETAIN_PAST_HOURS = int(os.environ.get("EPG_RETAIN_PAST_HOURS", "6"))
+EPG_RETAIN_FUTURE_HOURS = int(os.environ.get("EPG_RETAIN_FUTURE_HOURS", "48"))
+# 内存中所有 EPG 数据的总预算 (MB)，超出后按最近最少使用淘汰
+EPG_MEMORY_BUDGET_MB = int(os.environ.get("EPG_MEMORY_BUDGET_MB", "256"))
+# EPG 缓存多久后向源站重新验证 (分钟)，过期期间继续使用旧数据，由后台刷新
+EPG_MAX_AGE_MINUTES = int(os.environ.get("EPG_MAX_AGE_MINUTES", "360"))
+# 预热时同时加载的 EPG 数量
+EPG_PREWARM_CONCURRENCY = int(os.environ.get("EPG_PREWARM_CONCURRENCY", "2"))
+
+# 名称清洗规则 (预编译)
+_BRACKET_RE = re.compile(r'[\(\[【「].*?[\)\]】」]')
+_NOISE_WORDS = [
+    "4K", "1080P", "HD", "高清", "超清", "频道", 
+    "TVB", "CCTV", "备用", "字幕", "匹配", 
+    "*sg", "geo-blocked", "fhd"
+]
+# 干扰词：按列表顺序逐个移除，独立成词时不区分大小写，否则只移除原样或小写形式
+# (顺序执行，前一个词移除后可能拼出新的独立词，合并成一个正则会改变结果)
+_NOISE_PATTERNS = [
+    (re.compile(rf'\b{re.escape(w)}\b', re.IGNORECASE), w, w.lower()) for w in _NOISE_WORDS
+]
+_SYMBOL_RE = re.compile(r'[^\w\u4e00-\u9fa5]')
+# 每个 EPG 条目缓存的候选词数量上限
+MAX_CANDIDATE_CACHE = 20000
+
+# 解析 XML 时每次从文件读取的字节数
+EPG_READ_CHUNK_SIZE = 256 * 1024
+# 会导致解析报错的低位控制字符 (0x00-0x1F，保留 TAB、LF、CR)
+_XML_CONTROL_BYTES = bytes(b for b in range(0x20) if b not in (0x09, 0x0a, 0x0d))
+_AMP = 0x26 # b"&"
+
+
+class _SanitizedReader:
+    """逐块读取 XML 文件并清洗 (删除控制字符、转义 " & ")，供 iterparse 增量解析
+
+    结果与整份读入后先删控制字符、再做 replace 完全相同；
+    块尾可能与下一块拼成 " & " 的几个字节留到下一块一起处理。
+    """
+
+    def __init__(self, f, chunk_size: int = EPG_READ_CHUNK_SIZE):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._carry = b""
+        self._eof = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof:
+            chunk = self._f.read(self._chunk_size)
+            if not chunk:
+                self._eof = True
+                break
+            data = self._carry + chunk.translate(None, _XML_CONTROL_BYTES)
+            # 切分点两侧都不是 & 时，不会有 " & " 横跨切分点，两段分别替换与整体替换等价
+            cut = len(data) - 2
+            while cut > 0 and (data[cut - 1] == _AMP or data[cut] == _AMP):
+                cut -= 1
+            if cut <= 0:
+                self._carry = data
+                continue
+            self._carry = data[cut:]
+            return data[:cut].replace(b' & ', b' &amp; ')
+        data, self._carry = self._carry, b""
+        return data.replace(b' & ', b' &amp; ')
+
+@lru_cache(maxsize=65536)
+def _to_hans(text: str) -> str:
+    return zhconv.convert(text, 'zh-hans')
+
+@lru_cache(maxsize=65536)
+def _to_hant(text: str) -> str:
+    return zhconv.convert(text, 'zh-hant')
+
 # 并发控制与请求合并
 _url_locks: Dict[str, asyncio.Lock] = {}
 _pending_futures: Dict[str, asyncio.Future] = {} # 用于合并相同 URL 的解析任务
+_refresh_tasks: Dict[str, asyncio.Task] = {} # 正在运行的后台刷新 (下载、验证、解析全部结束才移除)
 _url_refresh_timestamps: Dict[str, float] = {} # 记录上一次成功强制刷新的时间
 _locks_lock = asyncio.Lock()
 
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+@lru_cache(maxsize=4096)
+def _epoch_day(year: int, month: int, day: int) -> int:
+    """日期距 1970-01-01 的天数 (非法日期抛出 ValueError)"""
+    return date(year, month, day).toordinal() - _EPOCH_ORDINAL
+
+def _parse_time_fallback(value: str) -> int:
+    dt = date_parser.parse(value)
+    if dt.tzinfo is None: dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+def parse_xmltv_time(value: str) -> int:
+    """解析 XMLTV 时间 (YYYYMMDDhhmmss ±zzzz) 为 Unix 时间戳，无时区按 UTC
+
+    标准格式直接按位切片计算；不规范的写法回退到 dateutil。
+    """
+    s = value.strip()
+    digits = s[:14]
+    rest = s[14:].lstrip()
+    if len(digits) != 14 or not digits.isdigit():
+        return _parse_time_fallback(value)
+    if not rest:
+        offset = 0
+    elif len(rest) == 5 and rest[0] in "+-" and rest[1:].isdigit():
+        offset = int(rest[1:3]) * 3600 + int(rest[3:5]) * 60
+        if rest[0] == "-": offset = -offset
+    else:
+        return _parse_time_fallback(value)
+
+    hour, minute, second = int(s[8:10]), int(s[10:12]), int(s[12:14])
+    if hour > 23 or minute > 59 or second > 59:
+        return _parse_time_fallback(value)
+    try:
+        days = _epoch_day(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+    except ValueError:
+        return _parse_time_fallback(value)
+    return days * 86400 + hour * 3600 + minute * 60 + second - offset
+
+def _epg_meta_path(cache_path: str) -> str:
+    """EPG 缓存的元数据文件 (ETag / Last-Modified / 上次验证时间)"""
+    return os.path.splitext(cache_path)[0] + ".json"
+
+def _load_epg_meta(cache_path: str) -> dict:
+    try:
+        with open(_epg_meta_path(cache_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        # 旧版本留下的缓存没有元数据：按文件修改时间算作上次验证时间
+        return {"checked_at": os.path.getmtime(cache_path)} if os.path.exists(cache_path) else {}
+
+def _save_epg_meta(cache_path: str, meta: dict):
+    meta_path = _epg_meta_path(cache_path)
+    tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, meta_path)
+
+def epg_cache_path(url: str) -> str:
+    """EPG 在本地缓存的 XML 文件路径"""
+    return os.path.join(EPG_CACHE_DIR, f"{md5(url.encode()).hexdigest()}.xml")
+
 async def fetch_epg_cached(url: str, refresh: bool = False) -> str:
-    """原子化下载并缓存 EPG"""
+    """原子化下载并缓存 EPG
+
+    refresh=False 时，距上次验证不超过 EPG_MAX_AGE_MINUTES 的缓存直接使用；
+    其余情况带上 ETag / Last-Modified 向源站验证，未变化 (304) 时不重新下载。
+    """
     if not url: return None
         
-    url_hash = md5(url.encode()).hexdigest()
-    cache_path = os.path.join(EPG_CACHE_DIR, f"{url_hash}.xml")
-    tmp_path = cache_path + ".tmp"
+    cache_path = epg_cache_path(url)
+    has_cache = os.path.exists(cache_path)
+    meta = _load_epg_meta(cache_path) if has_cache else {}
     
-    # 1. 强缓存模式：如果 refresh=False 且文件存在，直接视为有效
-    if not refresh and os.path.exists(cache_path):
+    # 1. 缓存未过期：直接视为有效
+    if not refresh and has_cache and time.time() - meta.get("checked_at", 0) < EPG_MAX_AGE_MINUTES * 60:
         return cache_path
 
     # 下载不需要全局锁主干，只需针对该文件的临时下载锁
-    print(f"[EPG] 正在下载: {url}")
+    print(f"[EPG] 正在验证/下载: {url}")
     try:
         # 使用 APTVPlayer 的 UA 绕过 429 封锁
         headers = {
             "User-Agent": "APTVPlayer/1.3.9 (com.ios.aptv; build:1; iOS 15.1.0) Alamofire/5.2.2",
             "Accept": "*/*"
         }
+        # 2. 条件请求：带上次的 ETag / Last-Modified
+        if has_cache:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
         timeout = aiohttp.ClientTimeout(total=120, connect=20)
         async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
             async with session.get(url) as response:
+                if response.status == 304 and has_cache:
+                    print(f"[EPG] 未变化 (304): {url}")
+                    meta["checked_at"] = time.time()
+                    _save_epg_meta(cache_path, meta)
+                    return cache_path
                 if response.status != 200: 
                     print(f"[EPG] 下载响应异常 {url}: HTTP {response.status}")
-                    return cache_path if os.path.exists(cache_path) else None
-                content = await response.read()
-                
-                if url.endswith(".gz") or content[:2] == b'\x1f\x8b':
-                    try:
-                        with gzip.GzipFile(fileobj=io.BytesIO(content)) as gz:
-                            xml_content = gz.read()
-                    except: xml_content = content
-                else: xml_content = content
-                
-                # 先写临时文件，再瞬间移动（原子操作）
-                with open(tmp_path, "wb") as f:
-                    f.write(xml_content)
-                if os.path.exists(cache_path): os.remove(cache_path)
-                os.rename(tmp_path, cache_path)
+                    return cache_path if has_cache else None
+                # 分块写入临时文件并边下载边解压，完成后原子替换
+                old_mtime = os.stat(cache_path).st_mtime_ns if has_cache else None
+                result = await download_to_file(response, cache_path, MAX_EPG_SIZE_MB * 1024 * 1024)
+                if old_mtime and result["sha256"] == meta.get("sha256"):
+                    # 内容没变：保留原修改时间，已有的索引继续有效
+                    os.utime(cache_path, ns=(old_mtime, old_mtime))
+                _save_epg_meta(cache_path, {
+                    "url": url,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "sha256": result["sha256"],
+                    "checked_at": time.time()
+                })
         return cache_path
     except Exception as e:
         print(f"[EPG] 下载失败 {url}: {e}")
-        if os.path.exists(tmp_path): os.remove(tmp_path)
         return cache_path if os.path.exists(cache_path) else None
 
 class EPGManager:
     """EPG 管理器"""
-    _cache: Dict[str, Dict[str, Any]] = {}
+    _cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict() # 按最近使用排序 (LRU)
+    _cache_bytes = 0 # 内存缓存的估算总大小
     
     @classmethod
-    async def get_program(cls, epg_url: str, channel_id: str, channel_name: str, current_logo: str = None, refresh: bool = False) -> dict:
-        """获取频道节目 (带请求合并与超时保护)"""
-        if not epg_url: return {"title": "无 EPG 链接", "logo": None}
-        
+    def _cache_get(cls, url_hash: str):
+        entry = cls._cache.get(url_hash)
+        if entry is not None:
+            cls._cache.move_to_end(url_hash)
+        return entry
+
+    @classmethod
+    def _cache_put(cls, url_hash: str, entry: Dict[str, Any]):
+        """写入内存缓存，超出内存预算时淘汰最久未用的 EPG (至少保留刚写入的这一份)"""
+        old = cls._cache.pop(url_hash, None)
+        if old is not None:
+            cls._cache_bytes -= old["size"]
+        cls._cache[url_hash] = entry
+        cls._cache_bytes += entry["size"]
+
+        budget = EPG_MEMORY_BUDGET_MB * 1024 * 1024
+        while cls._cache_bytes > budget and len(cls._cache) > 1:
+            evicted_hash, evicted = cls._cache.popitem(last=False)
+            cls._cache_bytes -= evicted["size"]
+            print(f"[EPG] 内存超出预算，淘汰: {evicted_hash} ({evicted['size'] // 1024} KB)")
+
+    @staticmethod
+    def _estimate_size(data: dict) -> int:
+        """粗略估算一份 EPG 数据占用的内存 (字节)"""
+        size = 0
+        for chan, (starts, stops, titles) in data["programs"].items():
+            size += sys.getsizeof(chan) + starts.buffer_info()[1] * 16 + sys.getsizeof(titles)
+            size += sum(sys.getsizeof(t) for t in titles)
+        for mapping in (data["name_map"], data["logos"], data.get("reverse_logos", {})):
+            size += sys.getsizeof(mapping) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in mapping.items())
+        return size
+
+    @classmethod
+    async def _get_entry(cls, epg_url: str, refresh: bool = False):
+        """取得 EPG 的内存缓存条目 (带请求合并与超时保护)，失败返回 None
+
+        已有缓存时总是立即返回 (stale-while-revalidate)：过期或要求刷新时只在后台启动一次刷新。
+        """
         url_hash = md5(epg_url.encode()).hexdigest()
         now_ts = datetime.now(timezone.utc).timestamp()
         
         # 1. 内存缓存极速命中
-        if not refresh and url_hash in cls._cache:
-            entry = cls._cache[url_hash]
-            if now_ts - entry["timestamp"] < 3600:
-                return cls._lookup_in_memory(entry, channel_id, channel_name, current_logo)
+        entry = cls._cache_get(url_hash)
             
         # 2. 刷新频率控制 (Anti-Storm): 5 分钟内同一 URL 只允许一次真正的 refresh=True
         actual_refresh = refresh
@@ -97,102 +292,270 @@ class EPGManager:
                 # 前置记录尝试时间，防止下载过程中由于并发穿透再次触发下载
                 _url_refresh_timestamps[url_hash] = time.time()
 
-        # 3. 请求合并逻辑 (Future Coalescing)
-        async with _locks_lock:
-            if url_hash in _pending_futures:
-                fut = _pending_futures[url_hash]
-            else:
-                fut = asyncio.get_event_loop().create_future()
-                _pending_futures[url_hash] = fut
-                # 记录刷新任务属性
-                asyncio.create_task(cls._bg_refresh_at_url(epg_url, url_hash, actual_refresh))
-                
+        stale = entry is None or now_ts - entry["timestamp"] >= EPG_MAX_AGE_MINUTES * 60
+        fut = await cls._start_refresh(epg_url, url_hash, actual_refresh) if stale or actual_refresh else None
+        if entry is not None:
+            return entry
+
         try:
-            # 增加 10 秒硬超时
-            await asyncio.wait_for(fut, timeout=10.0)
-            if url_hash in cls._cache:
-                res = cls._lookup_in_memory(cls._cache[url_hash], channel_id, channel_name, current_logo)
-                return res
+            # 首次加载：增加 10 秒硬超时 (超时不影响后台任务继续执行)
+            await asyncio.wait_for(asyncio.shield(fut), timeout=10.0)
+            return cls._cache_get(url_hash)
         except Exception as e:
             # 记录详细错误堆栈防止静默退出
             import traceback
             print(f"[EPG] API 异常: {epg_url} -> {e}")
             traceback.print_exc()
-            
+        return None
+
+    @classmethod
+    async def _start_refresh(cls, epg_url: str, url_hash: str, refresh: bool) -> asyncio.Future:
+        """启动后台刷新 (同一地址同时只有一个)，返回首次可用时完成的 Future"""
+        # 请求合并逻辑 (Future Coalescing)
+        async with _locks_lock:
+            if url_hash in _pending_futures:
+                return _pending_futures[url_hash]
+            fut = asyncio.get_event_loop().create_future()
+            _pending_futures[url_hash] = fut
+            task = asyncio.create_task(cls._bg_refresh_at_url(epg_url, url_hash, refresh))
+            _refresh_tasks[url_hash] = task
+            task.add_done_callback(lambda t: _refresh_tasks.pop(url_hash, None) if _refresh_tasks.get(url_hash) is t else None)
+            return fut
+
+    @classmethod
+    async def warm(cls, epg_url: str, refresh: bool = False):
+        """在后台准备 EPG (不等待下载与解析完成)"""
+        if epg_url:
+            await cls._start_refresh(epg_url, md5(epg_url.encode()).hexdigest(), refresh)
+
+    @classmethod
+    async def prewarm(cls, epg_urls: Iterable[str]):
+        """预热：把这些 EPG 的索引载入内存并向源站验证，全部完成才返回 (同时最多处理 EPG_PREWARM_CONCURRENCY 个)"""
+        semaphore = asyncio.Semaphore(EPG_PREWARM_CONCURRENCY)
+
+        async def _warm(epg_url: str):
+            async with semaphore:
+                url_hash = md5(epg_url.encode()).hexdigest()
+                if cls._cache_get(url_hash) is not None:
+                    # 已在内存：过期时由 _get_entry 启动后台验证
+                    await cls._get_entry(epg_url)
+                else:
+                    await cls._start_refresh(epg_url, url_hash, False)
+                # 索引载入后就会通知等待者，但下载与解析可能还在进行；
+                # 等后台刷新本身结束再释放名额，并发上限才能真正限制下载和解析
+                task = _refresh_tasks.get(url_hash)
+                if task is not None:
+                    await asyncio.shield(task)
+
+        urls = list(dict.fromkeys(url for url in epg_urls if url))
+        if urls:
+            started = time.time()
+            await asyncio.gather(*(_warm(url) for url in urls), return_exceptions=True)
+            print(f"[EPG] 预热完成: {len(urls)} 个 EPG, 耗时 {time.time() - started:.1f}s")
+
+    @classmethod
+    async def get_program(cls, epg_url: str, channel_id: str, channel_name: str, current_logo: str = None, refresh: bool = False) -> dict:
+        """获取频道节目"""
+        if not epg_url: return {"title": "无 EPG 链接", "logo": None}
+        
+        entry = await cls._get_entry(epg_url, refresh)
+        if entry is not None:
+            # 查询参数可能缺省 (None)，与批量接口一样按空字符串匹配
+            return cls._lookup_in_memory(entry, channel_id or "", channel_name or "", current_logo)
         return {"title": "无节目信息", "logo": None}
 
+    @classmethod
+    async def get_programs(cls, epg_url: str, items: List[dict], refresh: bool = False) -> List[dict]:
+        """批量获取频道节目：同一 EPG 只取一次缓存条目，相同的频道只匹配一次
+
+        items 为 [{"tvg_id", "tvg_name", "current_logo"}]，返回一一对应的 {"title", "next", "logo"}。
+        """
+        if not epg_url: return [{"title": "无 EPG 链接", "logo": None} for _ in items]
+        
+        entry = await cls._get_entry(epg_url, refresh)
+        if entry is None:
+            return [{"title": "无节目信息", "logo": None} for _ in items]
+
+        results = []
+        seen = {}
+        for item in items:
+            key = (item.get("tvg_id") or "", item.get("tvg_name") or "", item.get("current_logo") or "")
+            res = seen.get(key)
+            if res is None:
+                res = seen[key] = cls._lookup_in_memory(entry, key[0], key[1], key[2])
+            results.append(res)
+        return results
+
+    @classmethod
+    async def get_entries(cls, epg_urls: List[str]) -> "OrderedDict[str, Dict[str, Any]]":
+        """并发取得多个 EPG 的缓存条目，返回 {地址: 条目}（保持传入顺序，加载失败的跳过）"""
+        entries = await asyncio.gather(*(cls._get_entry(url) for url in epg_urls))
+        return OrderedDict((url, entry) for url, entry in zip(epg_urls, entries) if entry is not None)
+
+    @classmethod
+    async def refresh(cls, epg_url: str):
+        """向源站重新验证 EPG 并在后台更新内存索引 (依赖它的精简 EPG 随之失效)"""
+        await cls._get_entry(epg_url, refresh=True)
+
+    @staticmethod
+    def _find_programs(cache_entry, channel_id, channel_name) -> Optional[str]:
+        """返回频道在该 EPG 中有节目的频道 ID，找不到返回 None"""
+        programs = cache_entry["programs"]
+        name_map = cache_entry["name_map"]
+        for cid in EPGManager._candidates(cache_entry, channel_id, channel_name):
+            if cid in programs:
+                return cid
+            actual_cid = name_map.get(cid)
+            if actual_cid in programs:
+                return actual_cid
+        return None
+
+    @staticmethod
+    def build_xmltv(sources: List[tuple], channels) -> bytes:
+        """按频道列表生成精简的 XMLTV (gzip 压缩)
+
+        sources 为 [(XML 路径, 缓存条目)]。频道 ID 取 tvg_id (没有则用频道名)，与 M3U 中的 tvg-id / tvg-name 对应；
+        每个频道取第一个有其节目的 EPG，节目从源 XML 原样复制 (保留简介、分类、分集等全部信息与完整天数)。
+        """
+        # 1. 用内存索引把输出的频道对应到各个来源中的频道 ID
+        wanted = [{} for _ in sources] # 来源频道 ID -> [输出频道 ID]
+        channel_lines = []
+        seen = set()
+        for c in channels:
+            key = c.tvg_id or c.name
+            if not key or key in seen:
+                continue
+            seen.add(key)
+
+            for i, (_, entry) in enumerate(sources):
+                cid = EPGManager._find_programs(entry, c.tvg_id or "", c.name or "")
+                if cid is None:
+                    continue
+                logo = c.logo or entry.get("logos", {}).get(cid)
+                icon = f'<icon src={quoteattr(logo)}/>' if logo else ""
+                channel_lines.append(f'<channel id={quoteattr(key)}><display-name>{escape(c.name or key)}</display-name>{icon}</channel>\n')
+                wanted[i].setdefault(cid, []).append(key)
+                break
+
+        # 2. 逐个来源流式扫描，命中的节目直接写入压缩流
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as out:
+            out.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n'.encode("utf-8"))
+            out.write("".join(channel_lines).encode("utf-8"))
+            for (xml_path, _), mapping in zip(sources, wanted):
+                if mapping:
+                    EPGManager._copy_programmes(xml_path, mapping, out)
+            out.write(b"</tv>\n")
+        return buf.getvalue()
+
+    @staticmethod
+    def _copy_programmes(xml_path: str, mapping: Dict[str, List[str]], out):
+        """把源 XML 中属于 mapping 各频道的 <programme> 原样写出，channel 属性换成输出中的频道 ID"""
+        try:
+            with open(xml_path, "rb") as f:
+                it = ET.iterparse(_SanitizedReader(f), events=("start", "end"))
+                _, root = next(it)
+                for event, elem in it:
+                    if event != "end" or elem.tag not in ("programme", "channel"):
+                        continue
+                    if elem.tag == "programme":
+                        keys = mapping.get(elem.get("channel"))
+                        if keys:
+                            elem.tail = None
+                            for key in keys:
+                                elem.set("channel", key)
+                                out.write(ET.tostring(elem, encoding="unicode").encode("utf-8") + b"\n")
+                    root.clear()
+        except Exception as e:
+            # 遇到损坏的 XML 片段：保留已复制的部分
+            print(f"[EPG] 复制节目中断 {xml_path}: {e}")
+
+    @classmethod
+    async def _load_entry(cls, url_hash: str, xml_path: str):
+        """把 XML 的索引载入内存缓存；文件与索引都没变时只更新验证时间"""
+        entry = cls._cache.get(url_hash)
+        if entry is not None and entry.get("source") == cls._file_source(xml_path) and cls._index_fresh(entry["built_at"]):
+            entry["timestamp"] = datetime.now(timezone.utc).timestamp()
+            return
+        loop = asyncio.get_event_loop()
+        parsed_data = await loop.run_in_executor(None, cls._load_index, xml_path)
+        cls._cache_put(url_hash, {
+            "timestamp": datetime.now(timezone.utc).timestamp(),
+            "programs": parsed_data["programs"],
+            "name_map": parsed_data["name_map"],
+            "logos": parsed_data["logos"],
+            "reverse_logos": parsed_data.get("reverse_logos", {}),
+            "built_at": parsed_data["built_at"],
+            "source": parsed_data["source"],
+            "size": cls._estimate_size(parsed_data)
+        })
+        print(f"[EPG] 解析完成: 加载了 {len(parsed_data['name_map'])} 个频道变体, {len(parsed_data['programs'])} 个节目源")
+
     @classmethod
     async def _bg_refresh_at_url(cls, epg_url: str, url_hash: str, refresh: bool):
         """后台执行真正的数据抓取与解析"""
         try:
+            # 内存里还没有而磁盘上有旧文件：先载入旧数据，让等待的请求立即返回，再向源站验证
+            cache_path = epg_cache_path(epg_url)
+            if cls._cache.get(url_hash) is None and os.path.exists(cache_path):
+                await cls._load_entry(url_hash, cache_path)
+                cls._notify(url_hash)
+
             xml_path = await fetch_epg_cached(epg_url, refresh=refresh)
             if xml_path and os.path.exists(xml_path):
-                loop = asyncio.get_event_loop()
-                parsed_data = await loop.run_in_executor(None, cls._parse_epg_file, xml_path)
-                cls._cache[url_hash] = {
-                    "timestamp": datetime.now(timezone.utc).timestamp(),
-                    "programs": parsed_data["programs"],
-                    "name_map": parsed_data["name_map"],
-                    "logos": parsed_data["logos"],
-                    "reverse_logos": parsed_data.get("reverse_logos", {})
-                }
+                await cls._load_entry(url_hash, xml_path)
                 # 如果是强制刷新成功，记录时间戳
                 if refresh:
                     _url_refresh_timestamps[url_hash] = time.time()
-                
-                print(f"[EPG] 解析完成: 加载了 {len(parsed_data['name_map'])} 个频道变体, {len(parsed_data['programs'])} 个节目源")
         except Exception as e:
             print(f"[EPG] 后台解析崩溃: {e}")
             import traceback
             traceback.print_exc()
         finally:
             # 1. 显式通知所有等待该 URL 加载的请求
-            async with _locks_lock:
-                fut = _pending_futures.get(url_hash)
-                if fut and not fut.done():
-                    fut.set_result(True)
+            cls._notify(url_hash)
             
             # 2. 延迟 2 秒移除标记，防止前端瞬间重复触发下载
-            await asyncio.sleep(2)
-            async with _locks_lock:
-                if url_hash in _pending_futures:
-                    _pending_futures.pop(url_hash, None)
+            # (用定时回调而不是在任务里等待，任务结束即代表刷新完成，预热据此释放并发名额)
+            asyncio.get_event_loop().call_later(2, _pending_futures.pop, url_hash, None)
 
     @staticmethod
+    def _notify(url_hash: str):
+        fut = _pending_futures.get(url_hash)
+        if fut and not fut.done():
+            fut.set_result(True)
+
+    @staticmethod
+    @lru_cache(maxsize=65536)
     def _clean_name(name: str) -> str:
-        """强化清洗名称用于模糊匹配 (自动支持简繁转换)"""
+        """强化清洗名称用于模糊匹配 (自动支持简繁转换)，结果按名称缓存"""
         if not name: return ""
-        import re
         # 0. 去除名字中的所有空格 (应对 "翡翠 台" 这种变体)
         name = name.replace(" ", "")
         
         # 1. 移除干扰符号和其中间内容
-        name = re.sub(r'[\(\[【「].*?[\)\]】」]', '', name)
+        name = _BRACKET_RE.sub('', name)
         # 2. 移除干扰词
-        noise = [
-            "4K", "1080P", "HD", "高清", "超清", "频道", 
-            "TVB", "CCTV", "备用", "字幕", "匹配", 
-            "*sg", "geo-blocked", "fhd"
-        ]
-        for word in noise:
-            escaped_word = re.escape(word)
-            name = re.sub(rf'\b{escaped_word}\b', '', name, flags=re.IGNORECASE)
-            name = name.replace(word, "").replace(word.lower(), "")
+        for pattern, word, lower in _NOISE_PATTERNS:
+            name = pattern.sub('', name)
+            name = name.replace(word, "").replace(lower, "")
         
         # 3. 移除特殊符号（保留汉字、字母、数字）
-        name = re.sub(r'[^\w\u4e00-\u9fa5]', '', name)
+        name = _SYMBOL_RE.sub('', name)
         name = name.strip().lower()
         
-        return zhconv.convert(name, 'zh-hans')
+        return _to_hans(name)
 
     @staticmethod
-    def _lookup_in_memory(cache_entry, channel_id, channel_name, current_logo=None):
-        """标准化多重查找策略"""
-        programs = cache_entry["programs"]
+    def _candidates(cache_entry, channel_id, channel_name) -> tuple:
+        """频道可能对应的 ID / 名称变体，按 EPG 条目缓存 (依赖该 EPG 的名称映射)"""
+        key = (channel_id, channel_name)
+        memo = cache_entry.setdefault("candidates", {})
+        cached = memo.get(key)
+        if cached is not None:
+            return cached
+
         name_map = cache_entry["name_map"]
-        logos = cache_entry.get("logos", {})
-        reverse_logos = cache_entry.get("reverse_logos", {})
-        
         candidates = set()
         
         # 收集所有可能的 ID 变体
@@ -200,8 +563,8 @@ class EPGManager:
         if channel_name:
             candidates.add(channel_name)
             # 简繁体变体
-            candidates.add(zhconv.convert(channel_name, 'zh-hans'))
-            candidates.add(zhconv.convert(channel_name, 'zh-hant'))
+            candidates.add(_to_hans(channel_name))
+            candidates.add(_to_hant(channel_name))
             
             # 内存映射映射查找
             for c in list(candidates):
@@ -212,14 +575,32 @@ class EPGManager:
             if c_name:
                 candidates.add(c_name)
                 # 清洗后的繁体变体也能路过一下
-                candidates.add(zhconv.convert(c_name, 'zh-hant'))
+                candidates.add(_to_hant(c_name))
                 
             # 再次深度尝试映射关系
             for c in list(candidates):
                 if c in name_map: candidates.add(name_map[c])
 
+        cached = tuple(candidates)
+        if len(memo) >= MAX_CANDIDATE_CACHE:
+            memo.clear()
+        memo[key] = cached
+        return cached
+
+    @staticmethod
+    def _lookup_in_memory(cache_entry, channel_id, channel_name, current_logo=None):
+        """标准化多重查找策略"""
+        programs = cache_entry["programs"]
+        name_map = cache_entry["name_map"]
+        logos = cache_entry.get("logos", {})
+        reverse_logos = cache_entry.get("reverse_logos", {})
+        
+        candidates = EPGManager._candidates(cache_entry, channel_id, channel_name)
+
         now_dt = datetime.now(timezone.utc)
+        now_ts = int(now_dt.timestamp())
         found_title = "无节目信息"
+        found_next = None
         found_logo = None
         
         # 深度调试与匹配追踪
@@ -239,10 +620,14 @@ class EPGManager:
 
             if actual_cid in programs and found_title == "无节目信息":
                 if is_target: print(f"[EPG] 匹配追踪 [{channel_name}]: ID '{actual_cid}' 在节目库中命中！")
-                for start_dt, stop_dt, title in programs[actual_cid]:
-                    if start_dt <= now_dt <= stop_dt:
-                        found_title = title
-                        break
+                # 节目按开始时间排序，二分查找最后一个已开始的节目，其后一个即下一个节目
+                starts, stops, titles = programs[actual_cid]
+                j = bisect_right(starts, now_ts)
+                if j > 0 and now_ts <= stops[j - 1]:
+                    found_title = titles[j - 1]
+                    found_next = titles[j] if j < len(titles) else None
+                elif found_next is None and j < len(titles):
+                    found_next = titles[j]
                 if is_target and found_title == "无节目信息":
                     print(f"[EPG] 匹配追踪 [{channel_name}]: 命中频道但无当前时段节目 (当前时间: {now_dt})")
             
@@ -252,7 +637,62 @@ class EPGManager:
             if found_title != "无节目信息" and found_logo:
                 break
                 
-        return {"title": found_title, "logo": found_logo}
+        return {"title": found_title, "next": found_next, "logo": found_logo}
+
+    @staticmethod
+    def _file_source(xml_path) -> list:
+        """XML 文件的版本标识 (修改时间, 大小)"""
+        st = os.stat(xml_path)
+        return [st.st_mtime_ns, st.st_size]
+
+    @staticmethod
+    def _index_fresh(built_at) -> bool:
+        """索引只含构建时保留窗口内的节目，未来部分用掉一半后需要重建"""
+        return time.time() - (built_at or 0) < EPG_RETAIN_FUTURE_HOURS * 3600 / 2
+
+    @staticmethod
+    def _load_index(xml_path):
+        """读取 XML 对应的紧凑索引 (epg_cache/{hash}.idx)，索引缺失或 XML 已更新时重新解析并写入"""
+        index_path = os.path.splitext(xml_path)[0] + ".idx"
+        source = EPGManager._file_source(xml_path)
+        try:
+            with open(index_path, "rb") as f:
+                data = marshal.load(f)
+            fresh = EPGManager._index_fresh(data.get("built_at"))
+            if data.get("version") == EPG_INDEX_VERSION and data.get("source") == source and fresh:
+                programs = {}
+                for chan, (starts, stops, titles) in data["programs"].items():
+                    starts_arr, stops_arr = array("q"), array("q")
+                    starts_arr.frombytes(starts)
+                    stops_arr.frombytes(stops)
+                    programs[chan] = (starts_arr, stops_arr, titles)
+                data["programs"] = programs
+                print(f"[EPG] 读取索引: {index_path}")
+                return data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[EPG] 索引损坏，重新解析: {e}")
+
+        data = EPGManager._parse_epg_file(xml_path)
+        data["source"] = source
+        try:
+            # 先写临时文件再改名，避免并发读到半截索引
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                marshal.dump({
+                    "version": EPG_INDEX_VERSION,
+                    "source": source,
+                    "built_at": data["built_at"],
+                    "programs": {chan: (starts.tobytes(), stops.tobytes(), titles) for chan, (starts, stops, titles) in data["programs"].items()},
+                    "name_map": data["name_map"],
+                    "logos": data["logos"],
+                    "reverse_logos": data["reverse_logos"]
+                }, f)
+            os.replace(tmp_path, index_path)
+        except Exception as e:
+            print(f"[EPG] 写入索引失败: {e}")
+        return data
 
     @staticmethod
     def _parse_epg_file(xml_path):
@@ -261,67 +701,72 @@ class EPGManager:
         name_map = {}
         logos = {}
         reverse_logos = {}
-        import re
+        
+        # 保留窗口：结束于窗口之前或开始于窗口之后的节目直接丢弃
+        built_at = int(time.time())
+        keep_from = built_at - EPG_RETAIN_PAST_HOURS * 3600
+        keep_until = built_at + EPG_RETAIN_FUTURE_HOURS * 3600
         
         try:
-            # 方案：二进制读取 + 暴力纠正编码瑕疵
-            with open(xml_path, 'rb') as f:
-                raw_data = f.read()
-            
+            # 方案：二进制分块读取 + 边读边纠正编码瑕疵，内存占用只与块大小有关
             # 1. 过滤掉所有可能导致 parsing 报错的低位控制字符 (0x00-0x1F)
             # 除了 0x09 (TAB), 0x0A (LF), 0x0D (CR)
-            cleaned_data = re.sub(rb'[\x00-\x08\x0b\x0c\x0e-\x1f]', b'', raw_data)
-            
             # 2. 解决常见的 & 符号未转义问题 (XML 禁忌)
             # 很多 EPG 源直接写 "A & B" 而不是 "A &amp; B"
-            cleaned_data = cleaned_data.replace(b' & ', b' &amp; ')
-            
-            # 使用 io.BytesIO 模拟流式解析，并采用更鲁棒的迭代模式
-            it = ET.iterparse(io.BytesIO(cleaned_data), events=("start", "end"))
-            _, root = next(it)
+            with open(xml_path, 'rb') as f:
+                it = ET.iterparse(_SanitizedReader(f), events=("start", "end"))
+                _, root = next(it)
             
-            while True:
-                try:
-                    event, elem = next(it)
-                    if event == "end":
-                        if elem.tag == "channel":
-                            cid = elem.get("id")
-                            if cid:
-                                for dn in elem.findall("display-name"):
-                                    if dn.text:
-                                        text = dn.text.strip()
-                                        for t in [text, zhconv.convert(text, 'zh-hans'), zhconv.convert(text, 'zh-hant')]:
-                                            name_map[t] = cid
-                                        cleaned = EPGManager._clean_name(text)
-                                        if cleaned: name_map[cleaned] = cid
-                                icon = elem.find("icon")
-                                if icon is not None:
-                                    src = icon.get("src")
-                                    if src: logos[cid] = src
+                while True:
+                    try:
+                        event, elem = next(it)
+                        if event == "end":
+                            if elem.tag == "channel":
+                                cid = elem.get("id")
+                                if cid:
+                                    for dn in elem.findall("display-name"):
+                                        if dn.text:
+                                            text = dn.text.strip()
+                                            for t in [text, _to_hans(text), _to_hant(text)]:
+                                                name_map[t] = cid
+                                            cleaned = EPGManager._clean_name(text)
+                                            if cleaned: name_map[cleaned] = cid
+                                    icon = elem.find("icon")
+                                    if icon is not None:
+                                        src = icon.get("src")
+                                        if src: logos[cid] = src
                                     
-                        elif elem.tag == "programme":
-                            chan = elem.get("channel")
-                            start_str = elem.get("start")
-                            stop_str = elem.get("stop")
-                            if chan and start_str and stop_str:
-                                try:
-                                    start_dt = date_parser.parse(start_str)
-                                    stop_dt = date_parser.parse(stop_str)
-                                    if start_dt.tzinfo is None: start_dt = start_dt.replace(tzinfo=timezone.utc)
-                                    if stop_dt.tzinfo is None: stop_dt = stop_dt.replace(tzinfo=timezone.utc)
-                                    title_elem = elem.find("title")
-                                    title = title_elem.text if title_elem is not None else "未知节目"
-                                    if chan not in programs: programs[chan] = []
-                                    programs[chan].append((start_dt, stop_dt, title))
-                                except: pass
-                        root.clear()
-                except StopIteration:
-                    break
-                except Exception as ex:
-                    # 遇到损坏的 XML 片段，跳过这一段继续寻找下一个标签
-                    continue
+                            elif elem.tag == "programme":
+                                chan = elem.get("channel")
+                                start_str = elem.get("start")
+                                stop_str = elem.get("stop")
+                                if chan and start_str and stop_str:
+                                    try:
+                                        start_ts = parse_xmltv_time(start_str)
+                                        stop_ts = parse_xmltv_time(stop_str)
+                                        if keep_from <= stop_ts and start_ts <= keep_until:
+                                            title_elem = elem.find("title")
+                                            title = title_elem.text if title_elem is not None else "未知节目"
+                                            if chan not in programs: programs[chan] = []
+                                            programs[chan].append((start_ts, stop_ts, title))
+                                    except: pass
+                            root.clear()
+                    except StopIteration:
+                        break
+                    except Exception as ex:
+                        # 遇到损坏的 XML 片段，跳过这一段继续寻找下一个标签
+                        continue
                     
         except Exception as e:
             print(f"[EPG] 解析遇到严重异常: {e}")
             
-        return {"programs": programs, "name_map": name_map, "logos": logos, "reverse_logos": reverse_logos}
+        # 每个频道的节目按开始时间排序 (同一开始时间保持文件中的顺序)，拆成紧凑数组便于二分查找
+        for chan, items in programs.items():
+            items.sort(key=lambda p: p[0])
+            programs[chan] = (
+                array("q", [p[0] for p in items]),
+                array("q", [p[1] for p in items]),
+                [p[2] for p in items]
+            )
+            
+        return {"programs": programs, "name_map": name_map, "logos": logos, "reverse_logos": reverse_logos, "built_at": built_at}
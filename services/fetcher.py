@@ -1,4 +1,3 @@
-import re
 from typing import Optional, List
 import aiohttp
 import json
@@ -8,13 +7,30 @@ import hashlib
 import glob
 from models import Channel, TaskRecord
 from task_broker import broker, update_task_status
+from services.output_cache import OutputCache
+from services.channel_sync import sync_subscription_channels
+from services.parser import M3UParser
+from services.download import download_to_file, DOWNLOAD_CHUNK_SIZE, MAX_SUBSCRIPTION_SIZE_MB
 import asyncio
 
+# 订阅源缓存目录 (保存正文与 ETag / Last-Modified / 内容哈希)
+SOURCE_CACHE_DIR = "./source_cache"
+if not os.path.exists(SOURCE_CACHE_DIR):
+    os.makedirs(SOURCE_CACHE_DIR, exist_ok=True)
+
+# Git 仓库解析缓存 (仓库目录 -> {blob SHA: 频道行})，同时持久化到 repo_cache/{hash}.blobs.json
+GIT_BLOB_CACHE_VERSION = 1
+_git_blob_caches = {}
+
+# 订阅抓取并发控制
+FETCH_CONCURRENCY = 6 # 同时处理的源数量
+FETCH_PER_HOST_LIMIT = 2 # 同一主机的并发连接数
+
 @broker.task
 async def fetch_subscription_task(task_id: str, sub_id: int, url_str: str, ua: str, headers_json: str):
     """包装订阅抓取为后台任务"""
     from database import engine
-    from sqlmodel import Session, select
+    from sqlmodel import Session, select, func
     from models import Subscription, Channel
     from datetime import datetime
     
@@ -30,55 +46,41 @@ async def fetch_subscription_task(task_id: str, sub_id: int, url_str: str, ua: s
                 return
 
             print(f"[Task] 正在同步订阅: {sub.name} (ID: {sub.id})")
-            # 1. 记住当前已有的状态（禁用状态、检测结果），防止刷新后丢失
-            old_channels = session.exec(select(Channel).where(Channel.subscription_id == sub.id)).all()
-            print(f"[Task] 正在迁移旧频道状态 ({len(old_channels)} 个)...")
-            channel_states = {
-                c.url: {
-                    "is_enabled": c.is_enabled,
-                    "check_status": c.check_status,
-                    "check_date": c.check_date,
-                    "check_image": c.check_image
-                } for c in old_channels
-            }
-            
-            # 2. 清掉旧台
-            for c in old_channels:
-                session.delete(c)
-            session.commit()
-
-            # 3. 抓取并解析
-            all_channels, all_metadata = await IPTVFetcher.fetch_subscription(url_str, ua, headers_json, task_id)
+            # 1. 抓取并解析 (旧频道在同步完成前保持可用)
+            all_channels, all_metadata, content_hash = await IPTVFetcher.fetch_subscription(url_str, ua, headers_json, task_id, known_hash=sub.content_hash)
+            if all_channels is None:
+                # 所有源都没有变化：跳过解析与入库
+                sub.last_updated = datetime.utcnow()
+                sub.last_update_status = "Success"
+                session.add(sub)
+                session.commit()
+                await update_task_status(task_id, status="success", progress=100, message="订阅内容未变化，无需同步")
+                print(f"[Task] 订阅内容未变化，跳过同步: {task_id}")
+                channel_count = session.exec(select(func.count(Channel.id)).where(Channel.subscription_id == sub.id)).one()
+                return {"channel_count": channel_count, "unchanged": True}
             print(f"[Task] 抓取完成，解析得到 {len(all_channels)} 个频道")
             
-            # 4. 入库新台并恢复状态
-            print(f"[Task] 正在将新频道入库并恢复状态...")
-            for idx, item in enumerate(all_channels):
-                # 每 100 条频道核对一下任务状态，降低 DB 开销的同时保证响应灵敏度
-                if idx % 100 == 0:
-                    task = session.get(TaskRecord, task_id)
-                    if not task or task.status == "canceled":
-                        print(f"[Task] 入库中断: 任务 {task_id} 已由用户取消")
-                        await update_task_status(task_id, status="canceled", message="入库作业已由用户中止")
-                        return {"status": "canceled", "message": "入库已由用户中止"}
-
-                url = item.get("url")
-                state = channel_states.get(url, {})
-                channel = Channel(
-                    **item, 
-                    subscription_id=sub.id, 
-                    is_enabled=state.get("is_enabled", True),
-                    check_status=state.get("check_status"),
-                    check_date=state.get("check_date"),
-                    check_image=state.get("check_image")
-                )
-                session.add(channel)
+            # 2. 与已有频道差量同步，保留频道 ID 与启用/检测状态
+            print(f"[Task] 正在差量同步频道...")
+
+            def _is_canceled() -> bool:
+                with Session(engine) as check_session:
+                    task = check_session.get(TaskRecord, task_id)
+                    return not task or task.status == "canceled"
+
+            stats = await asyncio.to_thread(sync_subscription_channels, session, sub.id, all_channels, _is_canceled if task_id else None)
+            if stats is None:
+                print(f"[Task] 入库中断: 任务 {task_id} 已由用户取消")
+                await update_task_status(task_id, status="canceled", message="入库作业已由用户中止")
+                return {"status": "canceled", "message": "入库已由用户中止"}
             
             sub.last_updated = datetime.utcnow()
             sub.last_update_status = "Success"
+            sub.content_hash = content_hash
             session.add(sub)
             session.commit()
-            print(f"[Task] 数据库持久化完成")
+            OutputCache.invalidate_subscriptions([sub.id])
+            print(f"[Task] 数据库持久化完成: 新增 {stats['inserted']}，更新 {stats['updated']}，删除 {stats['deleted']}，未变 {stats['unchanged']}")
         
         if task_id:
             from database import engine
@@ -95,100 +97,12 @@ async def fetch_subscription_task(task_id: str, sub_id: int, url_str: str, ua: s
         await update_task_status(task_id, status="failure", message=f"同步失败: {str(e)}")
         raise e
 
-class M3UParser:
-    """M3U/TXT 解析器"""
-    
-    @staticmethod
-    def parse(content: str):
-        """解析播放列表（支持 M3U/TXT 格式）"""
-        channels = []
-        metadata = {}
-        lines = content.splitlines()
-        current_channel = None
-        current_group = "Default"
-        
-        # 检查前 20 行的全局 EPG 元数据
-        for line in lines[:20]:
-            line = line.strip()
-            if line.startswith("#EXTM3U"):
-                # 提取 x-tvg-url 或 url-tvg 属性
-                tvg_match = re.search(r'(?:x-tvg-url|url-tvg|tvg-url)="([^"]*)"', line, re.IGNORECASE)
-                if tvg_match:
-                    metadata["epg_url"] = tvg_match.group(1)
-                break
-
-        for line in lines:
-            line = line.strip()
-            if not line or line.startswith("//"):
-                continue
-
-            # M3U 格式检测 (#EXTINF 标签)
-            if line.startswith("#EXTINF"):
-                name = "Unknown"
-                if "," in line:
-                    # 频道名称通常出现在最后的逗号之后
-                    name = line.rsplit(",", 1)[1].strip()
-                
-                # 提取属性 (group-title, tvg-logo 等)
-                raw_attrs = re.findall(r'([\w-]+)=(?:"([^"]*)"|([^\s,]*))', line)
-                attrs = {}
-                for item in raw_attrs:
-                    key = item[0].lower()
-                    val = item[1] or item[2]
-                    attrs[key] = val
-                
-                current_channel = {
-                    "name": name,
-                    "group": attrs.get("group-title") or attrs.get("group") or current_group,
-                    "logo": attrs.get("tvg-logo") or attrs.get("logo") or "",
-                    "tvg_id": attrs.get("tvg-id") or attrs.get("id") or ""
-                }
-            # TXT 分组标题检测
-            elif ",#genre#" in line:
-                current_group = line.split(",")[0].strip()
-            # 链接行检测
-            elif any(line.lower().startswith(p) for p in ["http", "rtmp", "p3p", "rtp", "udp", "mms", "rtsp"]):
-                if current_channel:
-                    # 如果前一行是 #EXTINF，则填充其 URL
-                    current_channel["url"] = line
-                    channels.append(current_channel)
-                    current_channel = None
-                else:
-                    # 如果没有对应的 #EXTINF，则视为独立的 URL 行
-                    channels.append({
-                        "name": line.split("/")[-1],
-                        "url": line,
-                        "group": current_group,
-                        "logo": "",
-                        "tvg_id": ""
-                    })
-            # TXT 行检测 (频道名,链接)
-            else:
-                for sep in [",", "#"]:
-                    if sep in line:
-                        parts = line.split(sep, 1)
-                        name = parts[0].strip()
-                        url = parts[1].strip()
-                        # 验证 URL 部分是否符合协议
-                        if any(url.lower().startswith(p) for p in ["http", "rtmp", "p3p", "rtp", "udp", "mms", "rtsp"]):
-                            channels.append({
-                                "name": name,
-                                "url": url,
-                                "group": current_group,
-                                "logo": "",
-                                "tvg_id": ""
-                            })
-                            break
-
-        print(f"解析完成：共 {len(channels)} 个频道。元数据：{metadata}")
-        return channels, metadata
-
 class IPTVFetcher:
     """订阅抓取工具"""
     
     @staticmethod
-    def process_git_repo(url: str):
-        """处理 Git 仓库"""
+    def sync_git_repo(url: str):
+        """克隆或拉取 Git 仓库，返回 (仓库目录, HEAD 提交)"""
         repo_cache_base = "repo_cache"
         if not os.path.exists(repo_cache_base):
             os.makedirs(repo_cache_base)
@@ -225,33 +139,105 @@ class IPTVFetcher:
              print(f"Git 错误: {ex}")
              raise Exception(f"Git 错误: {ex}")
 
-        # 扫描 M3U 或 TXT 文件
-        source_files = []
-        for root, dirs, files in os.walk(repo_dir):
-            # 跳过隐藏目录 (如 .git)
-            dirs[:] = [d for d in dirs if not d.startswith('.')]
-            for file in files:
-                if file.lower().endswith(('.m3u', '.m3u8', '.txt')):
-                    # 跳过常见的说明文件和依赖文件
-                    if file.lower() in ["readme.txt", "requirements.txt", "license.txt"]:
-                        continue
-                    source_files.append(os.path.join(root, file))
-        
-        print(f"在仓库中发现 {len(source_files)} 个源文件。")
-        
+        head = subprocess.check_output(["git", "-C", repo_dir, "rev-parse", "HEAD"], timeout=10).decode().strip()
+        return repo_dir, head
+
+    @staticmethod
+    def list_git_sources(repo_dir: str) -> List[tuple]:
+        """列出 HEAD 中的播放列表文件，返回 [(相对路径, blob SHA)]，按路径排序"""
+        output = subprocess.check_output(["git", "-C", repo_dir, "ls-tree", "-r", "-z", "HEAD"], timeout=30)
+        sources = []
+        for entry in output.split(b"\0"):
+            if not entry:
+                continue
+            info, _, raw_path = entry.partition(b"\t")
+            mode, obj_type, sha = info.split()
+            # 跳过子模块、符号链接等
+            if obj_type != b"blob" or mode == b"120000":
+                continue
+            path = os.fsdecode(raw_path)
+            parts = path.split("/")
+            # 跳过隐藏目录 (如 .github)
+            if any(d.startswith(".") for d in parts[:-1]):
+                continue
+            file = parts[-1].lower()
+            if file.endswith(('.m3u', '.m3u8', '.txt')):
+                # 跳过常见的说明文件和依赖文件
+                if file in ["readme.txt", "requirements.txt", "license.txt"]:
+                    continue
+                sources.append((path, sha.decode()))
+        sources.sort()
+        return sources
+
+    @staticmethod
+    def _load_blob_cache(repo_dir: str) -> dict:
+        """读取仓库的解析缓存：blob SHA -> 频道行"""
+        cache = _git_blob_caches.get(repo_dir)
+        if cache is not None:
+            return cache
+        cache = {}
+        try:
+            with open(repo_dir + ".blobs.json", "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == GIT_BLOB_CACHE_VERSION:
+                cache = data.get("blobs", {})
+        except Exception:
+            pass
+        _git_blob_caches[repo_dir] = cache
+        return cache
+
+    @staticmethod
+    def _save_blob_cache(repo_dir: str, cache: dict):
+        _git_blob_caches[repo_dir] = cache
+        tmp_path = repo_dir + ".blobs.json.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": GIT_BLOB_CACHE_VERSION, "blobs": cache}, f, ensure_ascii=False)
+            os.replace(tmp_path, repo_dir + ".blobs.json")
+        except Exception as e:
+            print(f"保存仓库解析缓存失败: {e}")
+
+    @staticmethod
+    def parse_git_repo(repo_dir: str):
+        """解析仓库中的所有播放列表文件
+
+        以文件的 blob SHA 为键缓存解析结果，内容没变的文件直接复用，只解析新增或修改过的文件。
+        """
+        sources = IPTVFetcher.list_git_sources(repo_dir)
+        print(f"在仓库中发现 {len(sources)} 个源文件。")
+
+        cache = IPTVFetcher._load_blob_cache(repo_dir)
+
+        # 只解析缓存中没有的 blob (文件多时由进程池并行解析)
+        missing = {}
+        for path, sha in sources:
+            if sha not in cache and sha not in missing:
+                missing[sha] = os.path.join(repo_dir, path)
+        parsed_rows = {}
+        if missing:
+            results = M3UParser.parse_files([(fpath, "utf-8") for fpath in missing.values()])
+            for sha, result in zip(missing, results):
+                if result is not None:
+                    parsed_rows[sha] = result[0]
+
+        new_cache = {}
         all_channels = []
-        for fpath in source_files:
-            try:
-                with open(fpath, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    if not content.strip():
-                        continue
-                    channels, _ = M3UParser.parse(content)
-                    all_channels.extend(channels)
-            except Exception as e:
-                print(f"读取文件错误 {fpath}: {e}")
-        
-        print(f"从仓库中提取的总频道数: {len(all_channels)}")
+        for path, sha in sources:
+            rows = cache.get(sha)
+            if rows is None:
+                rows = parsed_rows.get(sha)
+            if rows is None:
+                # 解析失败的文件下次重试
+                continue
+            new_cache[sha] = rows
+            all_channels.extend(M3UParser.from_rows(rows))
+        parsed = len(parsed_rows)
+
+        # 只保留当前 HEAD 中仍存在的文件
+        if parsed or new_cache.keys() != cache.keys():
+            IPTVFetcher._save_blob_cache(repo_dir, new_cache)
+
+        print(f"从仓库中提取的总频道数: {len(all_channels)} (重新解析 {parsed} 个文件，复用 {len(sources) - len(missing)} 个)")
         return all_channels
 
     @staticmethod
@@ -266,8 +252,117 @@ class IPTVFetcher:
         )
 
     @staticmethod
-    async def fetch_subscription(url_str: str, ua: str, headers_json: str, task_id: Optional[str] = None):
-        """核心抓取函数"""
+    def _source_cache_paths(url: str):
+        """源缓存文件路径：(正文, 元数据)"""
+        url_hash = hashlib.md5(url.encode()).hexdigest()
+        return os.path.join(SOURCE_CACHE_DIR, f"{url_hash}.body"), os.path.join(SOURCE_CACHE_DIR, f"{url_hash}.json")
+
+    @staticmethod
+    def _looks_like_html(path: str) -> bool:
+        """分块扫描文件：含 <html 且不含 #EXTM3U 视为网页"""
+        has_html = has_m3u = False
+        tail = b""
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                # 带上前一块的末尾，避免标记被切开
+                data = tail + chunk
+                has_html = has_html or b"<html" in data.lower()
+                has_m3u = has_m3u or b"#EXTM3U" in data
+                tail = data[-7:]
+        return has_html and not has_m3u
+
+    @staticmethod
+    async def _download_source(session: aiohttp.ClientSession, url: str, headers: dict) -> Optional[dict]:
+        """下载单个源（条件请求），返回下载结果描述，失败时返回 None"""
+        print(f"--- 正在处理源: [{url}] ---")
+        try:
+            # 识别是否为 Git 仓库
+            if IPTVFetcher.is_git_url(url):
+                loop = asyncio.get_event_loop()
+                # 在线程池中执行耗时的 Git 操作
+                repo_dir, head = await loop.run_in_executor(None, IPTVFetcher.sync_git_repo, url)
+                return {"git": repo_dir, "sha": head}
+
+            # 普通 HTTP 抓取：带上次的 ETag / Last-Modified 做条件请求
+            body_path, meta_path = IPTVFetcher._source_cache_paths(url)
+            meta = {}
+            if os.path.exists(body_path) and os.path.exists(meta_path):
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                except Exception:
+                    meta = {}
+            req_headers = dict(headers)
+            if meta.get("etag"):
+                req_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                req_headers["If-Modified-Since"] = meta["last_modified"]
+
+            async with session.get(url, headers=req_headers, timeout=30) as response:
+                print(f"抓取响应状态: {response.status} (URL: {url})")
+                if response.status == 304 and meta.get("sha256"):
+                    print(f"源未变化 (304): {url}")
+                    return {"path": body_path, "sha": meta["sha256"], "charset": meta.get("charset")}
+                if response.status != 200:
+                    print(f"跳过 {url}: HTTP {response.status}")
+                    return None
+
+                # 边下载边写入缓存文件 (gzip 自动解压，超过上限则放弃)
+                charset = response.charset or "utf-8"
+                result = await download_to_file(response, body_path, MAX_SUBSCRIPTION_SIZE_MB * 1024 * 1024)
+                sha = result["sha256"]
+                # 防御性检查：如果是 HTML 而非播放列表，则跳过
+                if IPTVFetcher._looks_like_html(body_path):
+                    print(f"警告: 链接 {url} 返回了网页而非播放列表，已跳过。")
+                    os.remove(body_path)
+                    return None
+
+                if sha == meta.get("sha256"):
+                    print(f"源内容未变化 (哈希一致): {url}")
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump({
+                        "url": url,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "sha256": sha,
+                        "charset": charset
+                    }, f)
+                return {"path": body_path, "sha": sha, "charset": charset}
+        except Exception as e:
+            print(f"处理 {url} 时发生错误: {e}")
+            # 一个源失败后继续处理下一个源
+        return None
+
+    @staticmethod
+    def _parse_sources(results: List[Optional[dict]]) -> List[Optional[tuple]]:
+        """解析已下载的各个源，返回一一对应的 (频道列表, 元数据)，失败的为 None
+
+        HTTP 源一起交给 M3UParser.parse_files (数据量大时多进程并行)，Git 源按 blob 缓存增量解析。
+        """
+        parsed = [None] * len(results)
+        http_items = [(i, r) for i, r in enumerate(results) if r is not None and "git" not in r]
+        if http_items:
+            http_results = M3UParser.parse_files([(r["path"], r.get("charset") or "utf-8") for _, r in http_items])
+            for (i, _), result in zip(http_items, http_results):
+                if result is not None:
+                    rows, metadata = result
+                    print(f"解析完成：共 {len(rows)} 个频道。元数据：{metadata}")
+                    parsed[i] = (M3UParser.from_rows(rows), metadata)
+        for i, r in enumerate(results):
+            if r is not None and "git" in r:
+                try:
+                    parsed[i] = (IPTVFetcher.parse_git_repo(r["git"]), {})
+                except Exception as e:
+                    print(f"解析源失败: {e}")
+        return parsed
+
+    @staticmethod
+    async def fetch_subscription(url_str: str, ua: str, headers_json: str, task_id: Optional[str] = None, known_hash: Optional[str] = None):
+        """核心抓取函数（多个源并发抓取，结果按原始顺序合并）
+
+        返回 (频道列表, 元数据, 内容指纹)。内容指纹与 known_hash 一致时说明所有源都没有变化，
+        此时跳过解析，频道列表返回 None。
+        """
         # 支持逗号分隔多个地址
         urls = [u.strip() for u in url_str.split(",") if u.strip()]
         total_urls = len(urls)
@@ -285,54 +380,63 @@ class IPTVFetcher:
             headers = {}
         headers["User-Agent"] = ua
 
-        connector = aiohttp.TCPConnector(ssl=False)
+        results = [None] * total_urls
+        sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        async def _run(i: int, url: str):
+            async with sem:
+                return i, await IPTVFetcher._download_source(session, url, headers)
+
+        canceled = False
+        connector = aiohttp.TCPConnector(ssl=False, limit=FETCH_CONCURRENCY, limit_per_host=FETCH_PER_HOST_LIMIT)
         async with aiohttp.ClientSession(connector=connector) as session:
-            for i, url in enumerate(urls):
-                if task_id:
-                    # 检查是否已中止
-                    from sqlmodel import Session
-                    from database import engine
-                    with Session(engine) as db_session:
-                        task = db_session.get(TaskRecord, task_id)
-                        if task and task.status == "canceled":
-                            print(f"[Task] 任务 {task_id} 已由用户取消")
-                            await update_task_status(task_id, status="canceled", message="同步作业已由用户中止")
-                            return all_channels, all_metadata
-                            
-                    progress = int((i / total_urls) * 100)
-                    await update_task_status(task_id, progress=progress, message=f"处理源 ({i+1}/{total_urls}): {url[:30]}...")
-
-                print(f"--- 正在处理源: [{url}] ---")
-                try:
-                    # 识别是否为 Git 仓库
-                    if IPTVFetcher.is_git_url(url):
-                         import asyncio
-                         loop = asyncio.get_event_loop()
-                         # 在线程池中执行耗时的 Git 操作
-                         repo_channels = await loop.run_in_executor(None, IPTVFetcher.process_git_repo, url)
-                         all_channels.extend(repo_channels)
-                         continue
-
-                    # 普通 HTTP 抓取
-                    async with session.get(url, headers=headers, timeout=30) as response:
-                        print(f"抓取响应状态: {response.status} (URL: {url})")
-                        if response.status == 200:
-                            content = await response.text(errors='ignore')
-                            # 防御性检查：如果是 HTML 而非播放列表，则跳过
-                            if "<html" in content.lower() and "#EXTM3U" not in content:
-                                print(f"警告: 链接 {url} 返回了网页而非播放列表，已跳过。")
-                                continue
-                            
-                            channels, metadata = M3UParser.parse(content)
-                            all_channels.extend(channels)
-                            # 如果发现了 EPG URL 等元数据，进行合并
-                            if metadata:
-                                all_metadata.update(metadata)
-                        else:
-                            print(f"跳过 {url}: HTTP {response.status}")
-                except Exception as e:
-                    print(f"处理 {url} 时发生错误: {e}")
-                    # 一个源失败后继续处理下一个源
+            tasks = [asyncio.create_task(_run(i, url)) for i, url in enumerate(urls)]
+            try:
+                finished = 0
+                for fut in asyncio.as_completed(tasks):
+                    i, result = await fut
+                    results[i] = result
+                    finished += 1
+
+                    if task_id:
+                        # 检查是否已中止
+                        from sqlmodel import Session
+                        from database import engine
+                        with Session(engine) as db_session:
+                            task = db_session.get(TaskRecord, task_id)
+                            if task and task.status == "canceled":
+                                print(f"[Task] 任务 {task_id} 已由用户取消")
+                                await update_task_status(task_id, status="canceled", message="同步作业已由用户中止")
+                                canceled = True
+                                break
+                                
+                        progress = int((finished / total_urls) * 100)
+                        await update_task_status(task_id, progress=progress, message=f"已完成源 ({finished}/{total_urls}): {urls[i][:30]}...")
+            finally:
+                # 中止或异常时取消尚未完成的源
+                for t in tasks:
+                    if not t.done():
+                        t.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        # 内容指纹：各源 URL 与内容哈希 (Git 源为 HEAD 提交) 按顺序组合，失败的源记为 "-"
+        fingerprint = "\n".join(f"{url}\t{r['sha'] if r else '-'}" for url, r in zip(urls, results))
+        content_hash = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+        if not canceled and known_hash and content_hash == known_hash:
+            print(f"订阅内容未变化：{len(urls)} 个源均与上次同步一致，跳过解析。")
+            return None, all_metadata, content_hash
+
+        # 解析后按原始 URL 顺序合并，保证输出稳定
+        loop = asyncio.get_event_loop()
+        parsed = await loop.run_in_executor(None, IPTVFetcher._parse_sources, results)
+        for item in parsed:
+            if item is None:
+                continue
+            channels, metadata = item
+            all_channels.extend(channels)
+            # 如果发现了 EPG URL 等元数据，进行合并
+            if metadata:
+                all_metadata.update(metadata)
         
         print(f"订阅汇总完成：从 {len(urls)} 个源中共提取 {len(all_channels)} 个频道。")
-        return all_channels, all_metadata
+        return all_channels, all_metadata, content_hash
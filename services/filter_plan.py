@@ -0,0 +1,283 @@
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Set, Tuple
+from sqlmodel import Session, select
+
+from models import Channel, OutputSource
+from services.keyword_matcher import get_matcher
+from services.output_cache import OutputCache
+
+# 缓存上限
+MAX_PLANS = 256 # 过滤计划
+MAX_RESULTS = 32 # 过滤结果 (每条是一份频道列表)
+
+
+class ChannelRow:
+    """只读的频道投影：按列查询，不含截图等大字段，也不经过 Pydantic 校验
+
+    用于播放列表渲染、过滤、统计等热点路径，属性名与 Channel 相同。
+    """
+    FIELDS = ("id", "name", "url", "group", "logo", "tvg_id", "subscription_id", "is_enabled")
+    __slots__ = FIELDS
+
+    def __init__(self, id, name, url, group, logo, tvg_id, subscription_id, is_enabled, *extra):
+        self.id = id
+        self.name = name
+        self.url = url
+        self.group = group
+        self.logo = logo
+        self.tvg_id = tvg_id
+        self.subscription_id = subscription_id
+        self.is_enabled = is_enabled
+
+    @classmethod
+    def load(cls, session: Session, *where) -> list:
+        """按订阅内顺序查询频道"""
+        columns = [getattr(Channel, field) for field in cls.FIELDS]
+        statement = select(*columns).where(*where).order_by(Channel.subscription_id, Channel.position, Channel.id)
+        return [cls(*row) for row in session.exec(statement)]
+
+    def with_group(self, group: str) -> "ChannelRow":
+        """返回换了分组的新行，原行不变 (它可能在共享的缓存结果里)"""
+        row = object.__new__(type(self))
+        for field in self.FIELDS:
+            setattr(row, field, getattr(self, field))
+        row.group = group
+        return row
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class ChannelPreviewRow(ChannelRow):
+    """预览用的频道投影：额外带上检测结果 (截图字段只是 /thumbs/ 地址)"""
+    EXTRA_FIELDS = ("position", "check_status", "check_date", "check_image", "check_error", "check_source")
+    FIELDS = ChannelRow.FIELDS + EXTRA_FIELDS
+    __slots__ = EXTRA_FIELDS
+
+    def __init__(self, *values):
+        super().__init__(*values)
+        for field, value in zip(self.EXTRA_FIELDS, values[len(ChannelRow.FIELDS):]):
+            setattr(self, field, value)
+
+
+def _with_group(c, group: str):
+    """覆盖分组，不修改传入的频道对象"""
+    if isinstance(c, ChannelRow):
+        return c.with_group(group)
+    return c.model_copy(update={"group": group})
+
+
+class FilterPlan:
+    """过滤计划：聚合源过滤规则 (正则 + 关键字 + 排除列表) 解析、编译后的结果
+
+    以规则内容的哈希为 key 全局共享，同一套规则只解析、编译一次；
+    多个聚合源使用同一套规则时，同一份频道快照也只会过滤一次。
+    """
+    _plans: "OrderedDict[str, FilterPlan]" = OrderedDict() # 规则哈希 -> 计划
+    _raw_keys: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict() # 聚合源原始字段 -> 规则哈希 (省去重复 JSON 解析)
+    _results: "OrderedDict[tuple, list]" = OrderedDict() # (规则哈希, 频道快照...) -> 过滤结果
+    _counts: "OrderedDict[tuple, Tuple[int, int]]" = OrderedDict() # (规则哈希, 频道快照) -> (总数, 启用数) 统计摘要
+    _lock = threading.Lock()
+
+    def __init__(self, key: str, filter_regex: Optional[str], keywords: List[dict], excluded: Set[int]):
+        self.key = key
+        self.filter_regex = filter_regex
+        self.keywords = keywords
+        self.excluded = excluded
+
+        # 正则格式不正确时视同不过滤
+        self.pattern = None
+        if filter_regex:
+            try:
+                self.pattern = re.compile(filter_regex, re.IGNORECASE)
+            except re.error:
+                pass
+
+        self.values = [k.get("value", "").lower() for k in keywords]
+        self.groups = [k.get("group", "").strip() for k in keywords]
+        self.matcher = get_matcher(tuple(self.values)) if keywords else None
+
+    @staticmethod
+    def normalize_keywords(raw_keywords) -> List[dict]:
+        """关键字统一整理为 {"value", "group"}（兼容纯字符串写法）"""
+        keywords = []
+        for k in raw_keywords or []:
+            if isinstance(k, str):
+                keywords.append({"value": k, "group": ""})
+            elif isinstance(k, dict):
+                keywords.append({"value": k.get("value") or "", "group": k.get("group") or ""})
+        return keywords
+
+    @classmethod
+    def build(cls, filter_regex: Optional[str], keywords=None, excluded_ids=None) -> "FilterPlan":
+        """由已解析的规则取得过滤计划（按内容哈希复用）"""
+        regex = filter_regex if filter_regex and filter_regex != ".*" else None
+        norm_keywords = cls.normalize_keywords(keywords)
+        # 确保 ID 都是整数，防止前端传字符串导致匹配失败
+        try:
+            excluded = {int(i) for i in excluded_ids} if excluded_ids else set()
+        except (TypeError, ValueError):
+            excluded = set()
+
+        key = hashlib.sha1(json.dumps(
+            [regex, [[k["value"], k["group"]] for k in norm_keywords], sorted(excluded)],
+            ensure_ascii=False
+        ).encode("utf-8")).hexdigest()
+
+        with cls._lock:
+            plan = cls._plans.get(key)
+            if plan is not None:
+                cls._plans.move_to_end(key)
+                return plan
+
+        plan = cls(key, regex, norm_keywords, excluded)
+        with cls._lock:
+            cls._plans[key] = plan
+            while len(cls._plans) > MAX_PLANS:
+                cls._plans.popitem(last=False)
+        return plan
+
+    @classmethod
+    def for_output(cls, out: OutputSource) -> "FilterPlan":
+        """取得聚合源的过滤计划，字段未变化时不再重复解析 JSON"""
+        raw = (out.filter_regex or "", out.keywords or "[]", out.excluded_channel_ids or "[]")
+        with cls._lock:
+            key = cls._raw_keys.get(raw)
+            plan = cls._plans.get(key) if key else None
+        if plan is not None:
+            return plan
+
+        try:
+            keywords = json.loads(raw[1])
+        except:
+            keywords = []
+        try:
+            excluded_ids = json.loads(raw[2])
+        except:
+            excluded_ids = []
+        plan = cls.build(raw[0], keywords, excluded_ids)
+        with cls._lock:
+            cls._raw_keys[raw] = plan.key
+            while len(cls._raw_keys) > MAX_PLANS:
+                cls._raw_keys.popitem(last=False)
+        return plan
+
+    def _select(self, channels, use_exclusions: bool = True) -> list:
+        """筛选核心：返回 [(频道, 覆盖分组)]，不复制频道对象"""
+        excluded_set = self.excluded if use_exclusions else set()
+        selected = []
+
+        # 关键字筛选
+        if self.keywords:
+            matcher = self.matcher
+
+            # 单次扫描频道名，求出每个频道命中的最高优先级关键字，按关键字分桶（桶内保持原顺序）
+            buckets = [[] for _ in self.values]
+            for c in channels:
+                # 跳过聚合表级别排除的频道
+                if c.id in excluded_set:
+                    continue
+                idx = matcher.first_match(c.name.lower())
+                if idx != matcher.NO_MATCH:
+                    buckets[idx].append(c)
+
+            # 按关键字顺序输出，等价于原先 “逐关键字遍历频道” 的结果
+            # 使用 Set 避免同一个频道匹配多个关键字时出现重复
+            seen_ids = set()
+            seen_urls = set() # 增加 URL 去重，防止不同订阅源中的相同频道
+            for idx, bucket in enumerate(buckets):
+                # 如果指定了新分组，则覆盖原分组
+                target_group = self.groups[idx] or None
+                for c in bucket:
+                    if c.id in seen_ids or c.url in seen_urls:
+                        continue
+                    # 命中关键字
+                    selected.append((c, target_group))
+                    seen_ids.add(c.id)
+                    seen_urls.add(c.url)
+        else:
+            # 没关键字就按 URL 去重
+            seen_urls = set()
+            for c in channels:
+                # 跳过聚合表级别排除的频道
+                if c.id in excluded_set:
+                    continue
+                if c.url not in seen_urls:
+                    selected.append((c, None))
+                    seen_urls.add(c.url)
+
+        # 正则筛选
+        if self.pattern is not None:
+            pattern = self.pattern
+            selected = [item for item in selected if pattern.search(item[0].name)]
+
+        return selected
+
+    def apply(self, channels: list, use_exclusions: bool = True) -> list:
+        """根据关键字和正则筛选频道，并排除指定 ID 的频道
+
+        只有需要覆盖分组的频道才生成新对象，其余直接返回原对象，调用方不应修改结果中的频道。
+        """
+        return [_with_group(c, target_group) if target_group else c for c, target_group in self._select(channels, use_exclusions)]
+
+    def count_channels(self, session: Session, sub_ids: List[int]) -> Tuple[int, int]:
+        """统计指定订阅下命中本计划的频道数，返回 (总数, 启用数)
+
+        只查询过滤所需的列（不取截图等大字段），结果按频道快照版本缓存。
+        """
+        if not sub_ids:
+            return 0, 0
+        sub_key = tuple(sorted(set(sub_ids)))
+        count_key = (self.key, sub_key, OutputCache.snapshot_token(list(sub_key)))
+
+        with FilterPlan._lock:
+            cached = FilterPlan._counts.get(count_key)
+            if cached is not None:
+                FilterPlan._counts.move_to_end(count_key)
+                return cached
+
+        rows = session.exec(
+            select(Channel.id, Channel.name, Channel.url, Channel.is_enabled)
+            .where(Channel.subscription_id.in_(sub_key))
+            .order_by(Channel.subscription_id, Channel.position, Channel.id)
+        ).all()
+        selected = self._select(rows)
+        counts = (len(selected), sum(1 for c, _ in selected if c.is_enabled))
+
+        with FilterPlan._lock:
+            FilterPlan._counts[count_key] = counts
+            while len(FilterPlan._counts) > MAX_PLANS:
+                FilterPlan._counts.popitem(last=False)
+        return counts
+
+    def select_channels(self, session: Session, sub_ids: List[int], enabled_only: bool = False, use_exclusions: bool = True) -> List[ChannelRow]:
+        """取出指定订阅下的频道 (只读投影) 并应用本计划
+
+        结果按 (规则, 订阅集合, 频道快照版本) 缓存，规则相同的聚合源共享同一份结果；
+        返回的列表为共享对象，调用方不应增删其中元素。
+        """
+        if not sub_ids:
+            return []
+        sub_key = tuple(sorted(set(sub_ids)))
+        result_key = (self.key, sub_key, enabled_only, use_exclusions, OutputCache.snapshot_token(list(sub_key)))
+
+        with FilterPlan._lock:
+            cached = FilterPlan._results.get(result_key)
+            if cached is not None:
+                FilterPlan._results.move_to_end(result_key)
+                return cached
+
+        where = [Channel.subscription_id.in_(sub_key)]
+        if enabled_only:
+            where.append(Channel.is_enabled == True)
+        result = self.apply(ChannelRow.load(session, *where), use_exclusions)
+
+        with FilterPlan._lock:
+            FilterPlan._results[result_key] = result
+            while len(FilterPlan._results) > MAX_RESULTS:
+                FilterPlan._results.popitem(last=False)
+        return result
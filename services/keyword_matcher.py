@@ -0,0 +1,78 @@
+from collections import deque
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+
+class KeywordMatcher:
+    """多关键字匹配器 (Aho–Corasick)
+
+    一次扫描频道名即可找出命中的、优先级最高（下标最小）的关键字，
+    替代 “每个关键字 × 每个频道” 的逐一 in 判断。
+    """
+    NO_MATCH = -1
+
+    def __init__(self, patterns: List[str]):
+        # patterns 须已转小写；空串不参与匹配，但仍占一个下标以保持与原列表一一对应
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # 每个状态可命中的最小关键字下标（已沿失败链合并），无则为 len(patterns)
+        self._best: List[int] = [len(self.patterns)]
+        self._build()
+
+    def _build(self):
+        none = len(self.patterns)
+        goto, best = self._goto, self._best
+
+        # 1. 构建字典树
+        for idx, pattern in enumerate(self.patterns):
+            if not pattern:
+                continue
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    self._fail.append(0)
+                    best.append(none)
+                state = nxt
+            if idx < best[state]:
+                best[state] = idx
+
+        # 2. BFS 计算失败指针，并把失败链上的最优下标合并进来
+        fail = self._fail
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                target = goto[f].get(ch, 0)
+                fail[nxt] = target if target != nxt else 0
+                if best[fail[nxt]] < best[nxt]:
+                    best[nxt] = best[fail[nxt]]
+
+    def first_match(self, text: str) -> int:
+        """返回 text 中命中的最小关键字下标，未命中返回 NO_MATCH（text 须已转小写）"""
+        goto, fail, best = self._goto, self._fail, self._best
+        found = len(self.patterns)
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if best[state] < found:
+                found = best[state]
+                if found == 0:
+                    break
+        return found if found < len(self.patterns) else self.NO_MATCH
+
+
+@lru_cache(maxsize=128)
+def get_matcher(patterns: Tuple[str, ...]) -> KeywordMatcher:
+    """按关键字组合缓存编译好的匹配器，关键字不变就不会重新构建"""
+    return KeywordMatcher(list(patterns))
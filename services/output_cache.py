@@ -0,0 +1,159 @@
+import os
+import zlib
+import hashlib
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Iterable, Tuple, Union
+
+try:
+    import brotli
+except ImportError: # brotli 为可选依赖，缺失时只提供 gzip
+    brotli = None
+
+# 是否缓存渲染好的播放列表 (关闭后每次请求都重新渲染，边生成边以流式响应返回)
+OUTPUT_CACHE_ENABLED = bool(int(os.environ.get("OUTPUT_CACHE_ENABLED", "1")))
+
+# 每个聚合源最多缓存的变体数 (不同访问地址生成的播放列表、精简 EPG 等)
+MAX_VARIANTS_PER_SLUG = 8
+
+
+class OutputCache:
+    """聚合输出渲染缓存
+
+    按 slug 缓存渲染好的播放列表。失效不靠遍历删除，而是靠版本号：
+    订阅/频道变化时递增对应订阅的版本，聚合配置变化时递增对应 slug 的版本，
+    读取时版本对不上的条目即视为过期。
+    同一聚合源可按 variant 缓存多份内容 (如不同访问地址下的播放列表)，共用同一个版本号。
+    """
+    _entries: Dict[Tuple[str, str], dict] = {}
+
+    # 进程级标识：重启后版本号从 0 开始，加上它可避免与重启前的版本串重复
+    _epoch: str = uuid.uuid4().hex[:8]
+    _any_sub_version: int = 0 # 任意订阅变化都会递增 (用于未指定订阅、默认取全部的聚合源)
+    _sub_versions: Dict[int, int] = {}
+    _sub_changed_at: Dict[int, datetime] = {} # 订阅最近一次失效的时间 (参与 Last-Modified 计算)
+    # 启动前的频道变化 (开关、检测结果等) 没有持久化，重启后以启动时间作为变更时间的下限，
+    # 否则重启前拿到的 If-Modified-Since 可能比实际变化更晚，被误判为 304
+    _started_at: datetime = datetime.utcnow()
+    _slug_versions: Dict[str, int] = {}
+    _slug_changed_at: Dict[str, datetime] = {} # 聚合源配置最近一次修改的时间
+
+    @classmethod
+    def snapshot_token(cls, sub_ids: Optional[List[int]]) -> str:
+        """频道快照版本：关联订阅中任何一个发生变化，返回值都会改变"""
+        if sub_ids:
+            parts = ",".join(f"{sid}:{cls._sub_versions.get(sid, 0)}" for sid in sorted(set(sub_ids)))
+        else:
+            parts = f"*:{cls._any_sub_version}"
+        return f"{cls._epoch}|{parts}"
+
+    @classmethod
+    def token(cls, slug: str, sub_ids: Optional[List[int]]) -> str:
+        """某个聚合源当前的缓存版本"""
+        return f"{cls.snapshot_token(sub_ids)}|{slug}:{cls._slug_versions.get(slug, 0)}"
+
+    @classmethod
+    def changed_at(cls, sub_ids: Optional[List[int]], slug: Optional[str] = None) -> datetime:
+        """关联订阅频道或聚合源配置最近一次失效的时间 (不早于进程启动时间)"""
+        if sub_ids:
+            times = [cls._sub_changed_at[sid] for sid in sub_ids if sid in cls._sub_changed_at]
+        else:
+            times = list(cls._sub_changed_at.values())
+        if slug in cls._slug_changed_at:
+            times.append(cls._slug_changed_at[slug])
+        return max(times + [cls._started_at])
+
+    @staticmethod
+    def build_entry(token: str, sub_ids: Optional[List[int]], content: Union[str, bytes, Iterable[bytes]], last_modified: datetime, compress: bool = True) -> dict:
+        """生成缓存条目：原文、内容哈希 ETag 以及预压缩的 gzip/brotli 版本
+
+        content 也可以是字节块的迭代器 (流式渲染)，每块到达时即写入原文与压缩流，不生成中间的大字符串。
+        compress=False 用于本身已是压缩文件的内容 (如 .xml.gz)，只按原样返回。
+        """
+        if isinstance(content, str):
+            content = [content.encode("utf-8")]
+        elif isinstance(content, bytes):
+            content = [content]
+
+        digest = hashlib.sha256()
+        body = []
+        gz, gz_out = None, []
+        br, br_out = None, []
+        if compress:
+            # wbits=31 即 gzip 格式 (头部 mtime 为 0，相同内容压缩结果稳定)
+            gz = zlib.compressobj(6, zlib.DEFLATED, 31)
+            if brotli:
+                br = brotli.Compressor(quality=5)
+        for chunk in content:
+            if not chunk:
+                continue
+            digest.update(chunk)
+            body.append(chunk)
+            if gz:
+                gz_out.append(gz.compress(chunk))
+            if br:
+                br_out.append(br.process(chunk))
+        if gz:
+            gz_out.append(gz.flush())
+        if br:
+            br_out.append(br.finish())
+
+        entry = {
+            "token": token,
+            "sub_ids": sub_ids,
+            "body": b"".join(body),
+            "etag": digest.hexdigest()[:32],
+            "last_modified": last_modified.replace(microsecond=0),
+            "gzip": b"".join(gz_out) if gz else None,
+            "br": b"".join(br_out) if br else None
+        }
+        return entry
+
+    @classmethod
+    def get(cls, slug: str, variant: str = "") -> Optional[dict]:
+        """读取缓存，版本已过期则返回 None"""
+        key = (slug, variant)
+        entry = cls._entries.get(key)
+        if entry is None:
+            return None
+        if entry["token"] != cls.token(slug, entry["sub_ids"]):
+            cls._entries.pop(key, None)
+            return None
+        return entry
+
+    @classmethod
+    def put(cls, slug: str, entry: dict, variant: str = ""):
+        """写入缓存
+
+        entry["token"] 必须是渲染开始前取到的版本，
+        这样渲染过程中发生的失效会让这份结果在下次读取时直接作废。
+        """
+        key = (slug, variant)
+        cls._entries.pop(key, None)
+        cls._entries[key] = entry
+        # variant 可能来自请求 (如 Host 头)，按写入先后淘汰，防止无限增长
+        keys = [k for k in cls._entries if k[0] == slug]
+        for old in keys[:-MAX_VARIANTS_PER_SLUG]:
+            cls._entries.pop(old, None)
+
+    @classmethod
+    def invalidate_subscriptions(cls, sub_ids: Iterable[int]):
+        """订阅下的频道有变化（同步、开关、检测结果写回、订阅增删改）"""
+        now = datetime.utcnow()
+        for sid in set(sub_ids):
+            if sid is None:
+                continue
+            cls._sub_versions[sid] = cls._sub_versions.get(sid, 0) + 1
+            cls._sub_changed_at[sid] = now
+        cls._any_sub_version += 1
+
+    @classmethod
+    def invalidate_output(cls, *slugs: str):
+        """聚合源配置有变化（编辑、删除）"""
+        for slug in slugs:
+            if not slug:
+                continue
+            cls._slug_versions[slug] = cls._slug_versions.get(slug, 0) + 1
+            cls._slug_changed_at[slug] = datetime.utcnow()
+            for key in [k for k in cls._entries if k[0] == slug]:
+                cls._entries.pop(key, None)
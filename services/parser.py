@@ -0,0 +1,323 @@
+import os
+import re
+import codecs
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, List, Optional, Tuple
+
+# 预编译的匹配规则
+_TVG_URL_RE = re.compile(r'(?:x-tvg-url|url-tvg|tvg-url)="([^"]*)"', re.IGNORECASE)
+_ATTR_RE = re.compile(r'([\w-]+)=(?:"([^"]*)"|([^\s,]*))')
+# 认可的流媒体协议前缀 (最长 4 个字符，只需检查行首 4 个字符)
+_PROTOCOLS = ("http", "rtmp", "p3p", "rtp", "udp", "mms", "rtsp")
+# str.splitlines 认可的换行符
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+# 在文件开头多少行内查找全局 EPG 元数据
+_HEADER_LINES = 20
+# 分块读取文件时每块的字节数
+PARSE_CHUNK_SIZE = 256 * 1024
+# 紧凑的频道行 (元组) 字段顺序，用于解析缓存与跨进程传递
+CHANNEL_FIELDS = ("name", "url", "group", "logo", "tvg_id")
+# 解析进程池大小 (默认等于本进程可用的 CPU 数，受 taskset/cpuset 限制时以限制为准)
+_AVAILABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+PARSE_WORKERS = max(1, int(os.environ.get("PARSE_WORKERS", str(_AVAILABLE_CPUS))))
+# 待解析文件总大小达到该值才交给进程池，小文件在当前线程解析更快
+PARSE_POOL_MIN_BYTES = 4 * 1024 * 1024
+
+
+# 属性名 -> 小写形式 (非法属性名记为 "")，属性名种类很少，缓存后无需反复校验
+_attr_keys = {}
+
+
+def _normalize_key(raw: str) -> str:
+    bare = raw.replace("-", "").replace("_", "")
+    # 与 [\w-]+ 等价：\w 即 str.isalnum() 再加下划线
+    return raw.lower() if raw and (not bare or bare.isalnum()) else ""
+
+
+def _parse_attrs(line: str) -> dict:
+    """提取 #EXTINF 行的属性，结果与 _ATTR_RE.findall 逐项相同
+
+    常见的 key="value" 写法按引号切分直接取值，不走正则；
+    出现裸值、多余的等号等不规整写法时回退到正则。
+    """
+    parts = line.split('"')
+    n = len(parts)
+    # 引号不成对，或最后一段 (频道名) 里有等号
+    if n % 2 == 0 or "=" in parts[-1]:
+        return {key.lower(): quoted or bare for key, quoted, bare in _ATTR_RE.findall(line)}
+
+    attrs = {}
+    keys = _attr_keys
+    for i in range(0, n - 1, 2):
+        part = parts[i]
+        # 引号外的每一段都应以 “属性名=” 结尾，且只有这一个等号
+        if part[-1:] != "=" or part.count("=") != 1:
+            return {key.lower(): quoted or bare for key, quoted, bare in _ATTR_RE.findall(line)}
+        raw = part[:-1].rpartition(" ")[2]
+        key = keys.get(raw)
+        if key is None:
+            if len(keys) > 1024:
+                keys.clear()
+            key = keys[raw] = _normalize_key(raw)
+        if not key:
+            return {key.lower(): quoted or bare for key, quoted, bare in _ATTR_RE.findall(line)}
+        attrs[key] = parts[i + 1]
+    return attrs
+
+
+class _LineSplitter:
+    """把字节块增量解码并切分为行，只缓存最后一个不完整的行"""
+
+    def __init__(self, encoding: str = "utf-8"):
+        self._decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="ignore")
+        self._pending = ""
+
+    def feed(self, chunk: bytes) -> List[str]:
+        text = self._pending + self._decoder.decode(chunk)
+        if not text:
+            return []
+        lines = text.splitlines(True)
+        last = lines[-1][-1]
+        # 末行没有换行符（或以 \r 结尾，可能是被切开的 \r\n）时留到下一块
+        if last == "\r" or last not in _LINE_BREAKS:
+            self._pending = lines.pop()
+        else:
+            self._pending = ""
+        return lines
+
+    def close(self) -> List[str]:
+        text = self._pending + self._decoder.decode(b"", final=True)
+        self._pending = ""
+        return text.splitlines()
+
+
+class _ParseState:
+    """逐行解析的状态机，可以分批喂入行"""
+
+    def __init__(self, metadata: Optional[dict] = None):
+        self.metadata = metadata if metadata is not None else {}
+        self.current_channel = None
+        self.current_group = "Default"
+        self.lineno = 0
+        # 只在前 20 行内找第一个 #EXTM3U
+        self.header_done = False
+
+    def feed(self, lines: Iterable[str]) -> List[dict]:
+        """解析一批行，返回其中完整的频道"""
+        channels = []
+        append = channels.append
+        current_channel = self.current_channel
+        current_group = self.current_group
+        lineno = self.lineno
+
+        for line in lines:
+            lineno += 1
+            line = line.strip()
+            if not line:
+                continue
+            first = line[0]
+
+            if first == "#":
+                # 检查前 20 行的全局 EPG 元数据
+                if not self.header_done and lineno <= _HEADER_LINES and line.startswith("#EXTM3U"):
+                    self.header_done = True
+                    # 提取 x-tvg-url 或 url-tvg 属性
+                    tvg_match = _TVG_URL_RE.search(line)
+                    if tvg_match:
+                        self.metadata["epg_url"] = tvg_match.group(1)
+
+                # M3U 格式检测 (#EXTINF 标签)
+                if line.startswith("#EXTINF"):
+                    # 频道名称通常出现在最后的逗号之后
+                    name = line.rsplit(",", 1)[1].strip() if "," in line else "Unknown"
+
+                    # 提取属性 (group-title, tvg-logo 等)
+                    attrs = _parse_attrs(line)
+
+                    current_channel = {
+                        "name": name,
+                        "group": attrs.get("group-title") or attrs.get("group") or current_group,
+                        "logo": attrs.get("tvg-logo") or attrs.get("logo") or "",
+                        "tvg_id": attrs.get("tvg-id") or attrs.get("id") or ""
+                    }
+                    continue
+            elif first == "/" and line.startswith("//"):
+                continue
+
+            # TXT 分组标题检测
+            if ",#genre#" in line:
+                current_group = line.split(",", 1)[0].strip()
+            # 链接行检测
+            elif line[:4].lower().startswith(_PROTOCOLS):
+                if current_channel:
+                    # 如果前一行是 #EXTINF，则填充其 URL
+                    current_channel["url"] = line
+                    append(current_channel)
+                    current_channel = None
+                else:
+                    # 如果没有对应的 #EXTINF，则视为独立的 URL 行
+                    append({
+                        "name": line.rsplit("/", 1)[-1],
+                        "url": line,
+                        "group": current_group,
+                        "logo": "",
+                        "tvg_id": ""
+                    })
+            # TXT 行检测 (频道名,链接 或 频道名#链接)
+            else:
+                for sep in (",", "#"):
+                    name, found, url = line.partition(sep)
+                    if not found:
+                        continue
+                    url = url.strip()
+                    # 验证 URL 部分是否符合协议
+                    if url[:4].lower().startswith(_PROTOCOLS):
+                        append({
+                            "name": name.strip(),
+                            "url": url,
+                            "group": current_group,
+                            "logo": "",
+                            "tvg_id": ""
+                        })
+                        break
+
+        self.current_channel = current_channel
+        self.current_group = current_group
+        self.lineno = lineno
+        return channels
+
+
+class M3UParser:
+    """M3U/TXT 解析器"""
+
+    @staticmethod
+    def iter_parse(lines: Iterable[str], metadata: Optional[dict] = None) -> Iterator[dict]:
+        """逐行解析播放列表（支持 M3U/TXT 格式），全局元数据（如 EPG 地址）写入 metadata"""
+        yield from _ParseState(metadata).feed(lines)
+
+    @staticmethod
+    def iter_parse_bytes(chunks: Iterable[bytes], encoding: str = "utf-8", metadata: Optional[dict] = None) -> Iterator[dict]:
+        """从字节块序列增量解析，内存占用只与块大小有关"""
+        splitter = _LineSplitter(encoding)
+        state = _ParseState(metadata)
+        for chunk in chunks:
+            yield from state.feed(splitter.feed(chunk))
+        yield from state.feed(splitter.close())
+
+    @staticmethod
+    async def aiter_parse(chunks: AsyncIterable[bytes], encoding: str = "utf-8", metadata: Optional[dict] = None) -> AsyncIterator[dict]:
+        """从异步字节流（如 aiohttp 的 response.content.iter_chunked）增量解析"""
+        splitter = _LineSplitter(encoding)
+        state = _ParseState(metadata)
+        async for chunk in chunks:
+            for channel in state.feed(splitter.feed(chunk)):
+                yield channel
+        for channel in state.feed(splitter.close()):
+            yield channel
+
+    @staticmethod
+    def parse(content: str):
+        """解析播放列表（支持 M3U/TXT 格式）"""
+        metadata = {}
+        channels = _ParseState(metadata).feed(content.splitlines())
+        print(f"解析完成：共 {len(channels)} 个频道。元数据：{metadata}")
+        return channels, metadata
+
+    @staticmethod
+    def parse_file(path: str, encoding: str = "utf-8"):
+        """分块读取并解析本地播放列表文件"""
+        channels, metadata = _parse_path(path, encoding)
+        print(f"解析完成：共 {len(channels)} 个频道。元数据：{metadata}")
+        return channels, metadata
+
+    @staticmethod
+    def parse_files(items: List[Tuple[str, str]]) -> List[Optional[tuple]]:
+        """批量解析 [(文件路径, 编码)]，返回一一对应的 (频道行, 元数据)，失败的项为 None
+
+        总量较大时分发到进程池，各文件在多个核上并行解析，结果以紧凑元组传回。
+        """
+        total = 0
+        for path, _ in items:
+            try:
+                total += os.path.getsize(path)
+            except OSError:
+                pass
+
+        if PARSE_WORKERS > 1 and total >= PARSE_POOL_MIN_BYTES:
+            try:
+                pool = get_parse_pool()
+                futures = [pool.submit(parse_file_rows, path, encoding) for path, encoding in items]
+                results = []
+                for (path, _), future in zip(items, futures):
+                    try:
+                        results.append(future.result())
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        print(f"解析文件错误 {path}: {e}")
+                        results.append(None)
+                return results
+            except BrokenProcessPool:
+                # 工作进程异常退出 (如内存不足被杀)：重建进程池，本次改在当前线程解析
+                print("解析进程池异常，改为在当前线程解析")
+                shutdown_parse_pool()
+
+        results = []
+        for path, encoding in items:
+            try:
+                results.append(parse_file_rows(path, encoding))
+            except Exception as e:
+                print(f"解析文件错误 {path}: {e}")
+                results.append(None)
+        return results
+
+    @staticmethod
+    def to_rows(channels: List[dict]) -> List[tuple]:
+        """频道字典转为紧凑的元组"""
+        return [tuple(c.get(f, "") for f in CHANNEL_FIELDS) for c in channels]
+
+    @staticmethod
+    def from_rows(rows: Iterable[Iterable]) -> List[dict]:
+        """紧凑的元组还原为频道字典"""
+        return [dict(zip(CHANNEL_FIELDS, row)) for row in rows]
+
+
+def _parse_path(path: str, encoding: str = "utf-8"):
+    metadata = {}
+    with open(path, "rb") as f:
+        chunks = iter(lambda: f.read(PARSE_CHUNK_SIZE), b"")
+        channels = list(M3UParser.iter_parse_bytes(chunks, encoding, metadata))
+    return channels, metadata
+
+
+def parse_file_rows(path: str, encoding: str = "utf-8") -> Tuple[List[tuple], dict]:
+    """进程池工作函数：解析文件，返回 (紧凑频道行, 元数据)"""
+    channels, metadata = _parse_path(path, encoding)
+    return M3UParser.to_rows(channels), metadata
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    """解析进程池 (按需创建)
+
+    使用 spawn 方式启动：子进程只导入本模块，不会继承主进程的数据库连接和事件循环。
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def shutdown_parse_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
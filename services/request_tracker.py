@@ -0,0 +1,63 @@
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+from sqlalchemy import text
+
+# 批量落库间隔 (秒)
+FLUSH_INTERVAL = 15
+
+
+class RequestTracker:
+    """聚合源请求统计：读路径只写内存，由后台任务定期批量落库"""
+    _pending: Dict[int, dict] = {} # output_id -> {"last": 最近请求时间, "hits": 未落库的请求次数}
+    _lock = threading.Lock()
+
+    @classmethod
+    def touch(cls, output_id: int):
+        """记录一次请求"""
+        now = datetime.utcnow()
+        with cls._lock:
+            item = cls._pending.get(output_id)
+            if item is None:
+                cls._pending[output_id] = {"last": now, "hits": 1}
+            else:
+                item["last"] = now
+                item["hits"] += 1
+
+    @classmethod
+    def pending(cls, output_id: int) -> Optional[dict]:
+        """尚未落库的统计（列表接口用它补齐最新数据）"""
+        with cls._lock:
+            item = cls._pending.get(output_id)
+            return dict(item) if item else None
+
+    @classmethod
+    def flush(cls, engine) -> int:
+        """一次 UPDATE (executemany) 写入所有缓冲的请求统计，返回写入条数"""
+        with cls._lock:
+            if not cls._pending:
+                return 0
+            pending, cls._pending = cls._pending, {}
+
+        params = [
+            {"id": output_id, "last": item["last"], "hits": item["hits"]}
+            for output_id, item in pending.items()
+        ]
+        try:
+            with engine.begin() as conn:
+                conn.execute(
+                    text("UPDATE outputsource SET last_request_time = :last, "
+                         "request_count = COALESCE(request_count, 0) + :hits WHERE id = :id"),
+                    params
+                )
+        except Exception:
+            # 写库失败则放回缓冲区，下次再试
+            with cls._lock:
+                for output_id, item in pending.items():
+                    cur = cls._pending.get(output_id)
+                    if cur is None:
+                        cls._pending[output_id] = item
+                    else:
+                        cur["hits"] += item["hits"]
+            raise
+        return len(params)
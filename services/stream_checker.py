@@ -1,6 +1,5 @@
 import asyncio
 from typing import Optional, List
-import base64
 import os
 import subprocess
 import shutil
@@ -12,6 +11,8 @@ from sqlmodel import Session, select
 from static_ffmpeg import run
 from task_broker import broker, update_task_status, notifier
 from models import TaskRecord
+from services.output_cache import OutputCache
+from services.thumbs import ThumbStore
 
 @broker.task
 async def check_channels_task(task_id: str, channel_ids: List[int], source: str = 'manual'):
@@ -122,8 +123,8 @@ class StreamChecker:
                 with open(temp_filename, "rb") as f:
                     img_data = f.read()
                 
-                b64 = base64.b64encode(img_data).decode('utf-8')
-                return {"url": url, "status": True, "image": f"data:image/jpeg;base64,{b64}"}
+                # 截图存入缩略图库，只返回短地址
+                return {"url": url, "status": True, "image": ThumbStore.save(img_data)}
             else:
                 err_msg = result.stderr.decode('utf-8', errors='ignore') if result.stderr else "FFmpeg produced no image."
                 
@@ -230,6 +231,7 @@ class StreamChecker:
 
         # 批量写回数据库（过滤掉已取消的虚拟结果）
         from database import engine
+        touched_sub_ids = set()
         with Session(engine) as update_session:
             for res in results:
                 if res and res.get('ch_id') and res.get('status') != "canceled":
@@ -242,7 +244,9 @@ class StreamChecker:
                         ch.check_source = source
                         ch.is_enabled = res['status']
                         update_session.add(ch)
+                        touched_sub_ids.add(ch.subscription_id)
             update_session.commit()
+        OutputCache.invalidate_subscriptions(touched_sub_ids)
         return True
             
         # 清理进度标记属性，防止内存泄漏或属性过多
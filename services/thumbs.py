@@ -0,0 +1,101 @@
+import os
+import re
+import time
+import base64
+import hashlib
+from typing import Optional
+from sqlalchemy import text
+
+# 截图缓存目录
+THUMB_CACHE_DIR = "./thumb_cache"
+if not os.path.exists(THUMB_CACHE_DIR):
+    os.makedirs(THUMB_CACHE_DIR, exist_ok=True)
+
+THUMB_URL_PREFIX = "/thumbs/"
+# 清理无人引用的截图：间隔 (小时)，以及文件至少存在多久才会被清理 (给刚检测完、尚未写回的截图留出时间)
+THUMB_SWEEP_INTERVAL_HOURS = int(os.environ.get("THUMB_SWEEP_INTERVAL_HOURS", "6"))
+THUMB_SWEEP_MIN_AGE_HOURS = int(os.environ.get("THUMB_SWEEP_MIN_AGE_HOURS", "24"))
+_KEY_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ThumbStore:
+    """检测截图存储 (按内容寻址)
+
+    图片按内容哈希存放在磁盘上，频道表里只保存 /thumbs/{key}.jpg 这样的短地址，
+    相同画面只存一份，查询频道时也不会再带上大段 Base64。
+    """
+
+    @staticmethod
+    def path(key: str) -> Optional[str]:
+        """key 对应的文件路径，key 非法时返回 None"""
+        if not _KEY_RE.match(key or ""):
+            return None
+        return os.path.join(THUMB_CACHE_DIR, key[:2], f"{key}.jpg")
+
+    @staticmethod
+    def url(key: str) -> str:
+        return f"{THUMB_URL_PREFIX}{key}.jpg"
+
+    @classmethod
+    def save(cls, data: bytes) -> str:
+        """保存图片并返回访问地址"""
+        key = hashlib.sha256(data).hexdigest()[:32]
+        path = cls.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，避免并发读到半截图片
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        else:
+            # 刷新修改时间，避免刚被再次用到的旧截图在写回前被清理
+            os.utime(path)
+        return cls.url(key)
+
+    @classmethod
+    def sweep(cls, session, min_age_hours: int = THUMB_SWEEP_MIN_AGE_HOURS) -> int:
+        """删除频道表中已无人引用的截图 (及残留的临时文件)，返回删除数量"""
+        referenced = set()
+        for (image,) in session.exec(text(
+            "SELECT DISTINCT check_image FROM channel WHERE check_image LIKE :prefix"
+        ).bindparams(prefix=f"{THUMB_URL_PREFIX}%")).all():
+            referenced.add(image[len(THUMB_URL_PREFIX):].split(".", 1)[0])
+
+        deadline = time.time() - min_age_hours * 3600
+        removed = 0
+        for root, _, files in os.walk(THUMB_CACHE_DIR):
+            for name in files:
+                if name.split(".", 1)[0] in referenced and name.endswith(".jpg"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < deadline:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    @classmethod
+    def migrate_inline_images(cls, session, batch_size: int = 200) -> int:
+        """把频道表中旧的 Base64 截图迁移到磁盘，返回迁移数量"""
+        migrated = 0
+        while True:
+            rows = session.exec(text(
+                "SELECT id, check_image FROM channel WHERE check_image LIKE 'data:%' LIMIT :n"
+            ).bindparams(n=batch_size)).all()
+            if not rows:
+                break
+            params = []
+            for ch_id, data_uri in rows:
+                try:
+                    data = base64.b64decode(data_uri.split(",", 1)[1])
+                    params.append({"id": ch_id, "image": cls.save(data)})
+                except Exception:
+                    # 损坏的数据直接丢弃
+                    params.append({"id": ch_id, "image": None})
+            session.exec(text("UPDATE channel SET check_image = :image WHERE id = :id"), params=params)
+            session.commit()
+            migrated += len(params)
+        return migrated